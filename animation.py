@@ -0,0 +1,267 @@
+# Relay animations (blinking crossings, chasing signals, flickering lights...) compiled into timelines.
+# A Timeline is a list of edge times and the bitmask of output pins that are on from each edge until the next one,
+# optionally looping every period and ending after duration. The Animator evaluates every running timeline into one
+# bitmask whenever any of them reaches an edge and writes just the pins that changed, using a single event in the queue
+# for the next edge of all animations together. So the cost depends on how many frames actually change, not on how
+# many pulses every animation has.
+# Fades don't fit in a timeline of on/off edges, they step a pin's duty cycle through the io's software pwm instead
+# (see Fade).
+#
+#   animator.start(wigwag(drive_pin, pulse_interval=1, pulse_duration=0.3, duration=6), owner=trigger)
+#   Fade(worldstate, lamp_pin, 0, 1, fade_time=5, owner=trigger)
+from array import array
+from bisect import bisect_right
+import heapq
+import itertools
+import math
+import random
+import clock
+import pwm
+import trainio
+from events import Event
+from input_sampler import iter_bits
+
+# Timelines are evaluated this far past the requested time, so that evaluating exactly at an edge (give or take
+# floating point error) always sees the state after the edge
+EDGE_TOLERANCE = 1e-9
+
+class Timeline():
+    # edges[0] must be 0, masks[i] is the pins that are on from edges[i] until edges[i + 1] (or the end of the period)
+    def __init__(self, edges, masks, period=None, duration=None):
+        assert len(edges) == len(masks) and len(edges) > 0 and edges[0] == 0
+        assert period == None or period > edges[-1]
+        self.edges = array("d", edges)
+        self.masks = masks
+        self.period = period
+        self.duration = duration
+        # every pin the timeline ever turns on
+        self.pins = 0
+        for mask in masks:
+            self.pins |= mask
+
+    def is_finished(self, t):
+        return self.duration != None and t >= self.duration
+
+    # Pins that are on t seconds after the start
+    def mask_at(self, t):
+        if(self.is_finished(t)):
+            return 0
+        if(self.period != None):
+            t = t % self.period
+        return self.masks[bisect_right(self.edges, t) - 1]
+
+    # Time (since the start) of the first edge after t, None if nothing ever changes again
+    def next_change(self, t):
+        if(self.is_finished(t)):
+            return None
+        base = 0.0
+        phase = t
+        if(self.period != None):
+            base = math.floor(t / self.period) * self.period
+            phase = t - base
+        index = bisect_right(self.edges, phase)
+        if(index < len(self.edges)):
+            change = base + self.edges[index]
+        elif(self.period != None):
+            change = base + self.period
+        else:
+            change = None
+        if(self.duration != None and (change == None or change > self.duration)):
+            change = self.duration
+        return change
+
+def pin_mask(pins):
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+# pin on for duration (or until stopped if duration is None)
+def hold(pin, duration=None):
+    return Timeline([0], [1 << pin], None, duration)
+
+def blink(pin, on_time, off_time, duration=None):
+    return Timeline([0, on_time], [1 << pin, 0], on_time + off_time, duration)
+
+# pin on for pulse_duration every pulse_interval. If other_pin is given it's on for the rest of each interval, like a
+# pair of crossing lights. The animation runs until the first whole interval after duration, just like the original
+# self rescheduling wig wag did
+def wigwag(pin, pulse_interval, pulse_duration, duration=None, other_pin=None):
+    off_mask = 0 if other_pin == None else 1 << other_pin
+    if(duration != None):
+        duration = math.ceil(duration / pulse_interval) * pulse_interval
+    return Timeline([0, pulse_duration], [1 << pin, off_mask], pulse_interval, duration)
+
+# One pin at a time, step seconds each, in the given order, over and over
+def chase(pins, step, duration=None):
+    return Timeline([i * step for i in range(len(pins))], [1 << pin for pin in pins], len(pins) * step, duration)
+
+# pin randomly on and off, with on and off times picked between min_time and max_time. The random sequence is worked
+# out up front (length seconds of it) and then loops, so evaluating it costs the same as any other timeline
+def flicker(pin, min_time, max_time, length=10.0, duration=None, seed=None):
+    rng = random.Random(seed)
+    edges = []
+    masks = []
+    t = 0.0
+    on = True
+    while(t < length):
+        edges.append(t)
+        masks.append((1 << pin) if on else 0)
+        t += rng.uniform(min_time, max_time)
+        on = not on
+    return Timeline(edges, masks, t, duration)
+
+# Fades pin from start_duty to end_duty (0 to 1) over fade_time with the io's set_output_duty. The pwm refresher does
+# the fast switching, this only steps through the pwm levels in between, so a fade is at most 2^PWM_BITS events however
+# long it takes. Starts straight away, cancel_owner(owner) (or stop) leaves the pin at whatever duty it got to
+class Fade():
+    def __init__(self, worldstate, pin, start_duty, end_duty, fade_time, owner=None, on_finished=None):
+        self.worldstate = worldstate
+        self.pin = pin
+        self.owner = self if owner == None else owner
+        self.on_finished = on_finished
+        self.start_level = pwm.duty_level(start_duty)
+        self.end_level = pwm.duty_level(end_duty)
+        self.steps = max(1, abs(self.end_level - self.start_level))
+        self.step_time = fade_time / self.steps
+        self.step = 0
+        self.started_at = clock.now()
+        self.event = None
+        self.run_step()
+
+    def run_step(self):
+        level = self.start_level + (self.end_level - self.start_level) * self.step // self.steps
+        self.worldstate.io.set_output_duty(self.pin, level / ((1 << pwm.PWM_BITS) - 1))
+        if(self.step == self.steps):
+            self.event = None
+            if(self.on_finished != None):
+                self.on_finished()
+            return
+        self.step += 1
+        self.event = self.worldstate.event_queue.push(Event(self.started_at + self.step * self.step_time, self.run_step,
+                self.owner))
+
+    def stop(self):
+        if(self.event != None):
+            self.worldstate.event_queue.cancel(self.event)
+            self.event = None
+
+class Animation():
+    __slots__ = ("timeline", "started_at", "owner", "on_finished", "mask", "next_change", "running")
+
+    def __init__(self, timeline, started_at, owner, on_finished):
+        self.timeline = timeline
+        self.started_at = started_at
+        self.owner = owner
+        self.on_finished = on_finished
+        # pins the animation has on right now
+        self.mask = 0
+        # absolute time of the animation's next edge
+        self.next_change = started_at
+        self.running = True
+
+# Runs timelines on a WorldState's output pins. Pins are on while any running animation has them on, and the animator
+# only ever touches pins that an animation has turned on.
+# Animations are kept in a heap by their next edge, and only the animations that reached an edge get evaluated. The
+# number of running animations holding each pin on is counted, so the combined mask is updated from just the pins that
+# changed
+class Animator():
+    def __init__(self, worldstate):
+        self.worldstate = worldstate
+        # heap of (next_change, sequence, animation)
+        self.heap = []
+        self.sequence = itertools.count()
+        # owner -> list of that owner's running animations
+        self.owned_animations = {}
+        # pin -> number of running animations that have it on
+        self.pin_counts = {}
+        # pins whose count went from or to 0 since they were last written
+        self.changed = 0
+        self.next_event = None
+
+    def __len__(self):
+        return sum(len(animations) for animations in self.owned_animations.values())
+
+    # Starts timeline now. on_finished is called once the timeline runs past its duration (not when it gets stopped)
+    def start(self, timeline, owner=None, on_finished=None):
+        animation = Animation(timeline, clock.now(), owner, on_finished)
+        self.owned_animations.setdefault(owner, []).append(animation)
+        heapq.heappush(self.heap, (animation.next_change, next(self.sequence), animation))
+        self.refresh()
+        return animation
+
+    def stop(self, animation):
+        if(animation.running):
+            self.__finish(animation)
+            self.refresh()
+
+    def stop_owner(self, owner):
+        animations = self.owned_animations.get(owner)
+        if(animations != None):
+            for animation in list(animations):
+                self.__finish(animation)
+            self.refresh()
+
+    def __finish(self, animation):
+        animation.running = False
+        self.__set_mask(animation, 0)
+        animations = self.owned_animations[animation.owner]
+        animations.remove(animation)
+        if(len(animations) == 0):
+            del self.owned_animations[animation.owner]
+
+    def __set_mask(self, animation, mask):
+        for pin in iter_bits(animation.mask & ~mask):
+            self.pin_counts[pin] -= 1
+            if(self.pin_counts[pin] == 0):
+                del self.pin_counts[pin]
+                self.changed ^= 1 << pin
+        for pin in iter_bits(mask & ~animation.mask):
+            count = self.pin_counts.get(pin, 0)
+            if(count == 0):
+                self.changed ^= 1 << pin
+            self.pin_counts[pin] = count + 1
+        animation.mask = mask
+
+    # Evaluates every animation that has reached its next edge, writes the pins that changed and schedules the next refresh
+    def refresh(self):
+        now = clock.now()
+        finished = []
+        while(len(self.heap) > 0 and (not self.heap[0][2].running or self.heap[0][0] <= now + EDGE_TOLERANCE)):
+            animation = heapq.heappop(self.heap)[2]
+            if(not animation.running):
+                continue
+            t = now - animation.started_at + EDGE_TOLERANCE
+            if(animation.timeline.is_finished(t)):
+                self.__finish(animation)
+                finished.append(animation)
+                continue
+            self.__set_mask(animation, animation.timeline.mask_at(t))
+            change = animation.timeline.next_change(t)
+            if(change != None):
+                animation.next_change = animation.started_at + change
+                heapq.heappush(self.heap, (animation.next_change, next(self.sequence), animation))
+        self.apply()
+        self.schedule()
+        for animation in finished:
+            if(animation.on_finished != None):
+                animation.on_finished()
+
+    # Writes the pins that turned on or off (a pin that went off and back on again in the same refresh isn't written)
+    def apply(self):
+        changed = self.changed
+        self.changed = 0
+        for pin in iter_bits(changed):
+            self.worldstate.write_pin_state(pin, trainio.PIN_ON if pin in self.pin_counts else trainio.PIN_OFF)
+
+    def schedule(self):
+        while(len(self.heap) > 0 and not self.heap[0][2].running):
+            heapq.heappop(self.heap)
+        next_change = self.heap[0][0] if len(self.heap) > 0 else None
+        if(self.next_event != None):
+            if(self.next_event.queued and self.next_event.next_trigger_time == next_change):
+                return
+            self.worldstate.event_queue.cancel(self.next_event)
+            self.next_event = None
+        if(next_change != None):
+            self.next_event = self.worldstate.event_queue.push(Event(next_change, self.refresh, self))
@@ -0,0 +1,136 @@
+# asyncio based alternative to main.run. Instead of one loop doing everything in turn, the subsystems run as separate tasks:
+#   events  : each pushed Event becomes a loop.call_at timer
+#   inputs  : samples the inputs on its own executor thread and dispatches changes to the subscribers
+#   outputs : writes a frame on its own executor thread whenever the output pin state changed
+#   sounds  : runs sound completion handling that gets posted from the sound reaper threads
+#   reports : calls report() every report_interval, like main.run does with report_stats
+# Blocking GPIO work happens on the executor threads, so a slow output frame doesn't hold up input sampling or
+# triggers and vice versa. The triggers themselves don't know the difference, they still push Events onto
+# worldstate.event_queue, which is replaced with an AsyncEventQueue.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import clock
+
+# How often the inputs are sampled
+INPUT_SAMPLE_INTERVAL = 0.002
+
+# Drop in replacement for events.EventQueue (as far as triggers and WorldState are concerned)
+class AsyncEventQueue():
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.loop = runtime.loop
+        # loop.time() is normally time.monotonic() as well, but don't rely on it
+        self.offset = self.loop.time() - clock.now()
+        # owner -> set of that owner's pending events
+        self.owned_events = {}
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def push(self, event):
+        timer = self.loop.call_at(event.next_trigger_time + self.offset, self.fire, event)
+        self.timers[event] = timer
+        event.queued = True
+        if(event.owner != None):
+            self.owned_events.setdefault(event.owner, set()).add(event)
+        return event
+
+    def fire(self, event):
+        self.__remove(event)
+        self.runtime.stats.record(event.next_trigger_time, clock.now())
+        event.action()
+        self.runtime.output_changed()
+
+    def cancel(self, event):
+        if(event.cancelled):
+            return
+        event.cancelled = True
+        if(event in self.timers):
+            self.timers[event].cancel()
+            self.__remove(event)
+
+    def cancel_owner(self, owner):
+        for event in list(self.owned_events.get(owner, ())):
+            self.cancel(event)
+
+    def pending_for_owner(self, owner):
+        return len(self.owned_events.get(owner, ()))
+
+    def __remove(self, event):
+        del self.timers[event]
+        event.queued = False
+        events = self.owned_events.get(event.owner)
+        if(events != None):
+            events.discard(event)
+            if(len(events) == 0):
+                del self.owned_events[event.owner]
+
+    # Can be called from any thread
+    def post_threadsafe(self, action):
+        self.loop.call_soon_threadsafe(self.runtime.posted.put_nowait, action)
+
+class AsyncRuntime():
+    def __init__(self, ws, stats, loop, report=None, report_interval=60):
+        self.ws = ws
+        self.io = ws.io
+        self.stats = stats
+        self.loop = loop
+        self.report = report
+        self.report_interval = report_interval
+        self.posted = asyncio.Queue()
+        self.outputs_dirty = asyncio.Event()
+        # separate threads so that input sampling never waits behind an output frame
+        self.input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inputs")
+        self.output_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outputs")
+        old_queue = ws.event_queue
+        ws.event_queue = AsyncEventQueue(self)
+        # carry over anything that was scheduled before the runtime took over (i.e. the layout file watcher)
+        while(old_queue.peek() != None):
+            ws.event_queue.push(old_queue.pop())
+        self.io.set_sound_dispatcher(ws.event_queue.post_threadsafe)
+
+    def output_changed(self):
+        self.outputs_dirty.set()
+
+    async def run_inputs(self, interval):
+        while(True):
+            (state, changed) = await self.loop.run_in_executor(self.input_executor, self.io.scan_input_pins)
+            if(changed):
+                self.ws.apply_input_change(state, changed)
+                self.output_changed()
+            await asyncio.sleep(self.ws.sample_interval(interval))
+
+    async def run_outputs(self):
+        # outputs are only ever written by this task
+        self.io.begin_batch()
+        while(True):
+            await self.outputs_dirty.wait()
+            self.outputs_dirty.clear()
+            await self.loop.run_in_executor(self.output_executor, self.io.flush_output)
+            if(self.ws.control != None):
+                self.ws.control.publish_changes()
+
+    async def run_sounds(self):
+        while(True):
+            action = await self.posted.get()
+            action()
+            self.output_changed()
+
+    async def run_reports(self):
+        while(True):
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+    async def run(self, input_interval=INPUT_SAMPLE_INTERVAL):
+        tasks = [self.run_inputs(input_interval), self.run_outputs(), self.run_sounds()]
+        if(self.report != None):
+            tasks.append(self.run_reports())
+        await asyncio.gather(*tasks)
+
+# report() gets called every report_interval seconds, if given
+def run(ws, stats, report=None, report_interval=60):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runtime = AsyncRuntime(ws, stats, loop, report, report_interval)
+    loop.run_until_complete(runtime.run())
@@ -0,0 +1,398 @@
+# Benchmarks that can be run on a plain linux box (no GPIO hardware needed)
+# usage: python3 bench.py <benchmark> [args]
+import sys
+import time
+import random
+import re
+import shutil
+import subprocess
+import output_drivers
+import simple_sound_lib
+from events import Event, EventQueue
+
+NUM_BITS = 40
+CLOCK = 0.001
+
+# Measures how many frames per second each output driver can push
+def bench_output_drivers(num_frames):
+    gpio = output_drivers.NullGpio()
+    drivers = {
+        "bitbang": output_drivers.BitBangDriver(gpio, 4, 27, 17, NUM_BITS, CLOCK),
+        "bitbang_no_sleep": output_drivers.BitBangDriver(gpio, 4, 27, 17, NUM_BITS, 0),
+        "spi": output_drivers.SpiDriver(gpio, 17, NUM_BITS, spi=output_drivers.NullSpi()),
+    }
+    for name, driver in drivers.items():
+        recorder = output_drivers.FakeDriver(driver)
+        frames = num_frames
+        if(name == "bitbang"):
+            # the sleeping driver is slow enough that a handful of frames is plenty
+            frames = min(num_frames, 20)
+        for i in range(frames):
+            recorder.write_frame((i % (1 << NUM_BITS)).to_bytes(output_drivers.frame_bytes(NUM_BITS), "big"))
+        worst = max(duration for (start, duration, val) in recorder.frames)
+        print(name + ": " + "%.1f" % recorder.frames_per_second() + " frames/sec, worst frame " + "%.3f" % (worst * 1000) + "ms")
+
+# Measures how long refreshing every output takes as the number of 40 bit chains grows, with every chain changing in
+# every frame. Each chain gets the sleeping bitbang driver, so this is the worst case the layout hardware would see
+def bench_chains(num_frames):
+    import trainio
+    trainio.GPIO = output_drivers.NullGpio()
+    simple_sound_lib.set_backend(simple_sound_lib.FakeBackend())
+    for num_chains in [1, 2, 4, 8]:
+        chains = [trainio.OutputChain(NUM_BITS, 0, ser=0, srclk=0) for i in range(num_chains)]
+        board = trainio.Board(chains, [trainio.MuxBank([0, 0, 0, 0], 0, 16)])
+        drivers = [output_drivers.BitBangDriver(trainio.GPIO, 0, 0, 0, NUM_BITS, CLOCK) for chain in chains]
+        io = trainio.TrainIo(drivers, board)
+        start = time.perf_counter()
+        for i in range(num_frames):
+            io.begin_batch()
+            for pin in range(0, board.num_output_pins, NUM_BITS):
+                io.write_output_pin_state(pin + i % NUM_BITS, trainio.PIN_ON)
+                io.write_output_pin_state(pin + (i - 1) % NUM_BITS, trainio.PIN_OFF)
+            io.end_batch()
+        elapsed = time.perf_counter() - start
+        print(str(num_chains) + " chains / " + str(board.num_output_pins) + " outputs: " +
+                "%.1f" % (elapsed / num_frames * 1000) + "ms per refresh")
+
+# Measures push / cancel / pop throughput of the event queue with lots of pending events and owners
+def bench_event_queue(num_events):
+    eq = EventQueue()
+    owners = list(range(num_events // 10 + 1))
+    events = []
+    start = time.perf_counter()
+    for i in range(num_events):
+        # coarse times so that plenty of events share the same trigger time
+        events.append(eq.push(Event(random.randrange(1000) / 10.0, None, random.choice(owners))))
+    push_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for event in events[::4]:
+        eq.cancel(event)
+    for owner in owners[::4]:
+        eq.cancel_owner(owner)
+    cancel_time = time.perf_counter() - start
+    remaining = len(eq)
+
+    start = time.perf_counter()
+    popped = 0
+    for t in range(0, 1001):
+        popped += len(eq.pop_due(t / 10.0))
+    pop_time = time.perf_counter() - start
+    assert popped == remaining and len(eq) == 0
+
+    print("push: " + "%.0f" % (num_events / push_time) + " events/sec")
+    print("cancel: " + "%.3f" % (cancel_time * 1000) + "ms for " + str(num_events - remaining) + " events")
+    print("pop_due: " + "%.0f" % (popped / pop_time) + " events/sec")
+
+# Measures the time from asking for a sound to the first audio reaching the player
+def bench_sound_latency(num_sounds):
+    from trainsound import Sound
+    backends = {"fake": simple_sound_lib.FakeBackend()}
+    if(shutil.which("play") != None):
+        backends["sox_pool"] = simple_sound_lib.SoxPoolBackend()
+    for name, backend in backends.items():
+        simple_sound_lib.set_backend(backend)
+        sound = Sound("sounds/test")
+        latencies = []
+        for i in range(num_sounds):
+            start = time.monotonic()
+            sound.play_next_sound()
+            handle = sound.curr_sound_handle
+            while(handle.started_at == None and not handle.is_finished()):
+                time.sleep(0.0005)
+            if(handle.started_at != None):
+                latencies.append(handle.started_at - start)
+            sound.stop_current_sound()
+            time.sleep(0.2)
+        if(len(latencies) > 0):
+            print(name + ": trigger to first sample mean=" + "%.2f" % (sum(latencies) / len(latencies) * 1000) +
+                    "ms max=" + "%.2f" % (max(latencies) * 1000) + "ms")
+        if(hasattr(backend, "shutdown")):
+            backend.shutdown()
+
+# Measures how long it takes from launching a process until main runs its first tick. The child process goes through the
+# same startup as main.py, but with GPIO, the output driver and the sound backend swapped for fakes
+def bench_startup(num_runs):
+    for i in range(num_runs):
+        start = time.monotonic()
+        res = subprocess.run([sys.executable, __file__, "startup_child"], stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+        # the child logs through logging (to stderr), so the marker is the only thing it writes to stdout
+        first_tick = float(re.search(r"first_tick (\d+\.\d+)", res.stdout).group(1))
+        print("run " + str(i) + ": first tick at " + "%.3f" % (first_tick - start) + "s after launch")
+
+def startup_child():
+    import trainio
+    trainio.GPIO = output_drivers.NullGpio()
+    simple_sound_lib.set_backend(simple_sound_lib.FakeBackend())
+    import main
+    ws = main.setup(trainio.TrainIo(output_drivers.FakeDriver()))
+    main.run_tick(ws, ws.event_queue, main.LatenessStats("Event"), True)
+    print("first_tick " + str(time.monotonic()))
+
+# Runs the layout logic on the simulation clock with lots of triggers and pins and measures how fast it goes
+def bench_simulation(sim_seconds):
+    from simulation import Simulation
+    for (num_triggers, num_pins) in [(10, 16), (100, 64), (500, 256)]:
+        sim = Simulation(num_input_pins=num_pins)
+        specs = []
+        for i in range(num_triggers):
+            pin = i % num_pins
+            kind = i % 3
+            if(kind == 0):
+                specs.append({"type": "timed_relay", "name": "t" + str(i), "trigger_pin": pin, "drive_pin": i % 32,
+                        "duration": 3, "cooldown": 5})
+            elif(kind == 1):
+                specs.append({"type": "wigwag", "name": "t" + str(i), "trigger_pin": pin, "drive_pin": i % 32,
+                        "duration": 6, "cooldown": 10, "pulse_interval": 1, "pulse_duration": 0.3})
+            else:
+                specs.append({"type": "sound", "name": "t" + str(i), "trigger_pin": pin, "cooldown": 20,
+                        "sound": "test", "sound_channel": i % 8})
+        sim.load_layout(specs)
+        for pin in range(num_pins):
+            # stagger the pins so they don't all change at once
+            sim.square_wave(pin, 0.1 + pin * 0.37, 7.3, 0.5, int(sim_seconds / 7.3))
+        start = time.perf_counter()
+        sim.run_until(sim_seconds)
+        elapsed = time.perf_counter() - start
+        sim.close()
+        print(str(num_triggers) + " triggers / " + str(num_pins) + " pins: " + "%.0f" % (sim_seconds / elapsed) +
+                "x real time, " + "%.0f" % (sim.stats.count / elapsed) + " events/sec, " + str(len(sim.io.frames)) +
+                " frames, " + "%.1f" % (elapsed / max(1, sim.ticks) * 1e6) + "us per tick (input to output)")
+
+# Lots of wig wags blinking at once for a long time, i.e. a layout full of crossings, measuring how much event queue
+# traffic and time the blinking costs
+def bench_animations(sim_seconds):
+    from simulation import Simulation
+    for num_triggers in [10, 100, 400]:
+        sim = Simulation(num_input_pins=16)
+        specs = []
+        for i in range(num_triggers):
+            specs.append({"type": "wigwag", "name": "w" + str(i), "trigger_pin": i % 16, "drive_pin": i % 32,
+                    "duration": sim_seconds, "cooldown": 0, "pulse_interval": 1 + (i % 4) * 0.25, "pulse_duration": 0.3})
+        sim.load_layout(specs)
+        for pin in range(16):
+            sim.pulse(pin, 0.01 * pin, 0.5)
+        pushes = [0]
+        push = sim.eq.push
+        def counting_push(event):
+            pushes[0] += 1
+            return push(event)
+        sim.eq.push = counting_push
+        start = time.perf_counter()
+        sim.run_until(sim_seconds)
+        elapsed = time.perf_counter() - start
+        sim.close()
+        print(str(num_triggers) + " wig wags: " + "%.0f" % (sim_seconds / elapsed) + "x real time, " + str(pushes[0]) +
+                " events pushed, " + str(len(sim.io.frames)) + " frames, " + "%.1f" % (elapsed / len(sim.io.frames) * 1e6) +
+                "us per frame")
+
+# Memory per trigger and event, and how long dispatching a scan takes with the trigger table compared to calling
+# every trigger's fire_trigger through a subscription (like triggers used to). The triggers have a long cooldown, so
+# after the first scan nearly every check finds them cooling down, which is the common case on a real layout
+def bench_triggers(num_scans):
+    import random
+    import tracemalloc
+    from events import Event, EventQueue
+    from fakeio import FakeIo
+    from triggers import WorldState, Trigger
+    num_pins = 256
+    for num_triggers in [100, 500, 2000]:
+        for mode in ["table", "subscribers"]:
+            ws = WorldState(EventQueue(), FakeIo(num_pins, 40))
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            triggers = [Trigger("t" + str(i), ws, 1e9, i % num_pins, None, None) for i in range(num_triggers)]
+            if(mode == "subscribers"):
+                ws.trigger_table.watched_pins = 0
+                for trigger in triggers:
+                    ws.subscribe_to_state_change(trigger.trigger_pin, trigger.fire_trigger)
+            memory = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            ws.apply_input_change((1 << num_pins) - 1, (1 << num_pins) - 1)
+            rng = random.Random(1)
+            state = 0
+            start = time.perf_counter()
+            for i in range(num_scans):
+                changed = 0
+                for j in range(8):
+                    changed |= 1 << rng.randrange(num_pins)
+                state ^= changed
+                ws.apply_input_change(state, changed)
+            elapsed = time.perf_counter() - start
+            print(str(num_triggers) + " triggers, " + mode + ": " + str(memory // num_triggers) + " bytes per trigger, " +
+                    "%.1f" % (elapsed / num_scans * 1e6) + "us per scan")
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    events = [Event(1.0, None) for i in range(10000)]
+    print("events: " + str((tracemalloc.get_traced_memory()[0] - before) // len(events)) + " bytes per event")
+    tracemalloc.stop()
+
+# Round trips through the control api to a main loop running on a FakeIo, for single commands and for batches setting
+# many pins at once
+def bench_control(num_requests):
+    import os
+    import tempfile
+    import threading
+    import control
+    import main
+    from fakeio import FakeIo
+    main.METRICS_PORT = 0
+    main.CONTROL_SOCKET = os.path.join(tempfile.mkdtemp(), "control.sock")
+    io = FakeIo()
+    ws = main.setup(io)
+    threading.Thread(target=main.run, args=(ws,), daemon=True).start()
+    while(ws.control == None):
+        time.sleep(0.01)
+    client = control.ControlClient(main.CONTROL_SOCKET)
+    for batch_size in [1, 16]:
+        frames_before = len(io.frames)
+        times = []
+        for i in range(num_requests):
+            pins = {}
+            for pin in range(batch_size):
+                pins[str(pin)] = i % 2
+            start = time.perf_counter()
+            reply = client.request([{"op": "set", "pins": pins}])
+            times.append(time.perf_counter() - start)
+            assert reply["ok"], reply
+        times.sort()
+        print(str(batch_size) + " pins per request: mean=" + "%.2f" % (sum(times) / len(times) * 1000) + "ms p99=" +
+                "%.2f" % (times[int(len(times) * 0.99)] * 1000) + "ms, " + str(len(io.frames) - frames_before) +
+                " frames for " + str(num_requests) + " requests")
+    client.close()
+
+# Runs the pwm refresher on a null spi device and a bitbang driver without the sleeps while the main thread keeps
+# waking up every 10ms like the event loop does, to see what refresh rate and jitter the planes get and whether the
+# main loop still gets to run on time
+def bench_pwm(seconds):
+    import pwm
+    from events import LatenessStats
+    gpio = output_drivers.NullGpio()
+    drivers = {
+        "spi": output_drivers.SpiDriver(gpio, 17, NUM_BITS, spi=output_drivers.NullSpi()),
+        "bitbang_no_sleep": output_drivers.BitBangDriver(gpio, 4, 27, 17, NUM_BITS, 0),
+    }
+    num_bytes = output_drivers.frame_bytes(NUM_BITS)
+    levels = [(num_bytes - 1 - pin // 8, 1 << (pin % 8), pin % (1 << pwm.PWM_BITS)) for pin in range(NUM_BITS)]
+    for name, driver in drivers.items():
+        refresher = pwm.BcmRefresher(driver, pwm.make_planes(bytes(num_bytes), levels))
+        main_loop = LatenessStats("Main loop")
+        refresher.start()
+        start = time.monotonic()
+        while(time.monotonic() - start < seconds):
+            wake_at = time.monotonic() + 0.01
+            time.sleep(0.01)
+            main_loop.record(wake_at, time.monotonic())
+        refresher.stop()
+        elapsed = time.monotonic() - start
+        ideal = 1 / (pwm.PWM_UNIT * ((1 << pwm.PWM_BITS) - 1))
+        print(name + ": " + "%.0f" % (refresher.cycles / elapsed) + " cycles/sec (ideal " + "%.0f" % ideal + "), plane jitter " +
+                "%.3f" % (refresher.lateness.jitter() * 1000) + "ms, worst plane " + "%.3f" % (refresher.lateness.max_lateness * 1000) +
+                "ms late, main loop worst " + "%.3f" % (main_loop.max_lateness * 1000) + "ms late")
+
+# Keeps writing a pin image, until it gets killed
+def image_writer(name, num_pins):
+    from shared_state import PinImage
+    image = PinImage(name, num_pins)
+    state = 0
+    while(True):
+        state += 1
+        image.set(state & ((1 << num_pins) - 1))
+
+# Runs the supervisor on a FakeIo and kills writers part way through writing the images that restarted workers read
+# first (the io worker's inputs and outputs), then kills the workers. Checks that they all get restarted and start
+# heartbeating again, and how long that takes
+def bench_worker_restart(num_kills):
+    import os
+    import signal
+    import supervisor
+    import trainio
+    from shared_state import COUNTER
+    sup = supervisor.Supervisor(fake=True)
+    try:
+        for index in range(len(sup.workers)):
+            sup.start(index)
+        # wait for every worker to be up
+        while(min(sup.heartbeats) > time.monotonic() or time.monotonic() - min(sup.heartbeats) > 1):
+            time.sleep(0.1)
+        # the io worker is the only writer of both images, stop it so the killed writer is the only one
+        io_worker = sup.workers[supervisor.IO]
+        io_worker.process.kill()
+        io_worker.process.join()
+        for (name, image, num_pins) in [("inputs", sup.shared.inputs, trainio.BOARD.num_input_pins),
+                ("outputs", sup.shared.outputs, trainio.BOARD.num_output_pins)]:
+            kills = 0
+            while(COUNTER.unpack_from(image.buf, 0)[0] % 2 == 0):
+                writer = sup.context.Process(target=image_writer, args=(sup.prefix + name, num_pins), daemon=True)
+                writer.start()
+                time.sleep(random.uniform(0.2, 0.3))
+                os.kill(writer.pid, signal.SIGKILL)
+                writer.join()
+                kills += 1
+                if(kills >= num_kills):
+                    break
+            print(name + ": writer killed mid write after " + str(kills) + " tries" if
+                    COUNTER.unpack_from(image.buf, 0)[0] % 2 == 1 else name + ": writer never got killed mid write")
+        sup.workers[supervisor.LOGIC].process.kill()
+        sup.workers[supervisor.LOGIC].process.join()
+        killed_at = time.monotonic()
+        recovered = [None] * len(sup.workers)
+        while(time.monotonic() - killed_at < 30 and None in recovered):
+            sup.check()
+            for (index, worker) in enumerate(sup.workers):
+                # until the worker stamps its heartbeat itself it's WORKER_STARTUP_TIME after the (re)start
+                stamped = sup.heartbeats[index] < worker.started_at + supervisor.WORKER_STARTUP_TIME - 1
+                if(recovered[index] == None and worker.restarts > 0 and stamped and sup.heartbeats[index] > killed_at):
+                    recovered[index] = sup.heartbeats[index] - killed_at
+            time.sleep(0.05)
+        for (index, worker) in enumerate(sup.workers):
+            if(worker.restarts == 0):
+                continue
+            print(worker.name + " worker: " + ("back after " + "%.2f" % recovered[index] + "s" if recovered[index] != None
+                    else "DID NOT RECOVER") + ", restarted " + str(worker.restarts) + " times")
+    finally:
+        sup.stop()
+
+def main():
+    bench_type = sys.argv[1]
+    if(bench_type == "output_drivers"):
+        num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        bench_output_drivers(num_frames)
+    elif(bench_type == "chains"):
+        num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        bench_chains(num_frames)
+    elif(bench_type == "event_queue"):
+        num_events = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        bench_event_queue(num_events)
+    elif(bench_type == "sound_latency"):
+        num_sounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        bench_sound_latency(num_sounds)
+    elif(bench_type == "simulation"):
+        sim_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 600
+        bench_simulation(sim_seconds)
+    elif(bench_type == "animations"):
+        sim_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 600
+        bench_animations(sim_seconds)
+    elif(bench_type == "triggers"):
+        num_scans = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        bench_triggers(num_scans)
+    elif(bench_type == "control"):
+        num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        bench_control(num_requests)
+    elif(bench_type == "pwm"):
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+        bench_pwm(seconds)
+    elif(bench_type == "worker_restart"):
+        num_kills = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        bench_worker_restart(num_kills)
+    elif(bench_type == "startup"):
+        num_runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        bench_startup(num_runs)
+    elif(bench_type == "startup_child"):
+        startup_child()
+    else:
+        print("Unknown benchmark: " + bench_type)
+
+if __name__ == "__main__":
+    main()
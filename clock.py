@@ -0,0 +1,58 @@
+# Central time source for the scheduler.
+# Everything that schedules events or compares deadlines should go through here so that all
+# deadlines are on the same monotonic clock (time.time() can jump when ntp adjusts the Pi's clock)
+import os
+import time
+
+class RealClock():
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, duration):
+        if(duration > 0):
+            time.sleep(duration)
+
+# Virtual clock for simulations. Time only moves when sleep or advance_to is called
+class SimClock():
+    def __init__(self, start=0.0):
+        self.t = start
+
+    def now(self):
+        return self.t
+
+    def sleep(self, duration):
+        if(duration > 0):
+            self.t += duration
+
+    def advance_to(self, t):
+        if(t > self.t):
+            self.t = t
+
+current = RealClock()
+
+# Swaps the clock everything runs on (i.e. for a simulation), returns the previous clock
+def use_clock(new_clock):
+    global current
+    previous = current
+    current = new_clock
+    return previous
+
+def now():
+    return current.now()
+
+def sleep(duration):
+    current.sleep(duration)
+
+# Returns how many seconds ago this process was started, or None if that can't be worked out (i.e. not on linux).
+# Only accurate to the kernel clock tick (usually 10ms)
+def process_uptime():
+    try:
+        with open("/proc/self/stat") as f:
+            # the process name can contain spaces, so skip past the closing paren before splitting
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    # field 22 (starttime) is the 20th field after the process name
+    return system_uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
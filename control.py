@@ -0,0 +1,277 @@
+# Local control and telemetry API for the running layout, over a unix socket (main.CONTROL_SOCKET).
+# Every request is one line of json holding a batch of commands, and gets one line of json back:
+#   {"id": 7, "commands": [{"op": "set", "pins": {"3": 1, "4": 0}}, {"op": "play", "sound": "saloon", "channel": 2}]}
+#   {"id": 7, "ok": true, "results": [{}, {}]}
+# Commands:
+#   set       : {"pins": {pin: 0 or 1, ...}} sets output pins
+#   play      : {"sound": name, "channel": virtual channel or null, "priority": 0} plays a sound
+#   fire      : {"trigger": name} fires a trigger from the layout (as long as it isn't already on), whatever its pin
+#               and cooldown say. Results in {"fired": true/false}
+#   state     : results in {"inputs": input pin state, "outputs": output pin state, "triggers": {name: on}}
+#   subscribe : from now on the connection also gets a line {"event": "state", "t": ..., "inputs": ..., "outputs": ...}
+#               every time the input or output pins change
+# A batch is checked as a whole before any of it runs, so a bad command (unknown op, pin, sound or trigger) gets the
+# whole batch turned down with "ok": false and an "error" and nothing happens. A batch that passes runs on the main
+# loop and its output changes go out as a single frame. Sounds and triggers can't be taken back though, so if a command
+# fails while running (i.e. a sound player can't be started) the commands before it stay done, and the error says
+# which command failed.
+#
+#   python3 control.py set 3 1 | play saloon 2 | fire bats | state | watch
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import clock
+import trainio
+from train_sound_handler import ALL_SOUNDS
+
+log = logging.getLogger(__name__)
+
+class ControlError(ValueError):
+    pass
+
+def check_int(command, key, low, high, optional=False):
+    val = command.get(key)
+    if(val == None and optional):
+        return
+    if(type(val) != int or val < low or val >= high):
+        raise ControlError(command["op"] + ": " + key + " must be an integer from " + str(low) + " to " + str(high - 1))
+
+class Controller():
+    def __init__(self, ws):
+        self.ws = ws
+        # connections that asked for state changes
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.last_state = None
+
+    def trigger_named(self, name):
+        for trigger in self.ws.trigger_table.triggers:
+            if(trigger != None and trigger.name == name):
+                return trigger
+        raise ControlError("fire: unknown trigger " + str(name))
+
+    def check(self, command):
+        if(type(command) != dict):
+            raise ControlError("commands must be objects")
+        op = command.get("op")
+        if(op == "set"):
+            pins = command.get("pins")
+            if(type(pins) != dict):
+                raise ControlError("set: pins must be an object of pin: state")
+            for (pin, state) in pins.items():
+                if(not pin.isdigit() or int(pin) >= self.ws.num_output_pins):
+                    raise ControlError("set: no output pin " + pin)
+                if(state != trainio.PIN_ON and state != trainio.PIN_OFF):
+                    raise ControlError("set: pin " + pin + " must be set to 0 or 1")
+        elif(op == "play"):
+            if(not command.get("sound") in ALL_SOUNDS):
+                raise ControlError("play: unknown sound " + str(command.get("sound")))
+            check_int(command, "channel", 0, trainio.NUM_VIRTUAL_SOUND_CHANNELS, optional=True)
+            if(type(command.get("priority", 0)) != int):
+                raise ControlError("play: priority must be an integer")
+        elif(op == "fire"):
+            self.trigger_named(command.get("trigger"))
+        elif(op != "state" and op != "subscribe"):
+            raise ControlError("unknown op " + str(op))
+
+    def run(self, command, connection):
+        op = command["op"]
+        if(op == "set"):
+            for (pin, state) in command["pins"].items():
+                self.ws.write_pin_state(int(pin), state)
+        elif(op == "play"):
+            self.ws.io.play_sound(command["sound"], command.get("channel"), command.get("priority", 0))
+        elif(op == "fire"):
+            trigger = self.trigger_named(command["trigger"])
+            if(trigger.on):
+                return {"fired": False}
+            trigger.fire()
+            return {"fired": True}
+        elif(op == "state"):
+            return self.state()
+        elif(op == "subscribe"):
+            with self.subscribers_lock:
+                if(not connection in self.subscribers):
+                    self.subscribers.append(connection)
+        return {}
+
+    def state(self):
+        triggers = {}
+        for trigger in self.ws.trigger_table.triggers:
+            if(trigger != None):
+                triggers[trigger.name] = trigger.on
+        return {"inputs": self.ws.input_pin_states, "outputs": self.ws.io.virtual_output_pin_state, "triggers": triggers}
+
+    # Runs on the main loop. Checks every command, then runs them all in one output batch
+    def run_batch(self, commands, connection):
+        for command in commands:
+            self.check(command)
+        results = []
+        self.ws.io.begin_batch()
+        try:
+            for (index, command) in enumerate(commands):
+                try:
+                    results.append(self.run(command, connection))
+                except Exception as e:
+                    log.exception("Control command %d (%s) failed", index, command["op"])
+                    raise ControlError("command " + str(index) + " (" + command["op"] + ") failed, the " + str(index) +
+                            " before it were done: " + repr(e))
+        finally:
+            self.ws.io.end_batch()
+        return results
+
+    # Can be called from any thread, blocks until the main loop has run the batch. Returns the reply
+    def request(self, request, connection):
+        reply = {"id": request.get("id"), "ok": True}
+        commands = request.get("commands")
+        if(type(commands) != list):
+            reply.update({"ok": False, "error": "commands must be a list"})
+            return reply
+        result = Future()
+        def run():
+            try:
+                result.set_result(self.run_batch(commands, connection))
+            except ControlError as e:
+                result.set_exception(e)
+            except Exception as e:
+                # don't take the main loop down with a bad request
+                log.exception("Control request failed")
+                result.set_exception(ControlError(repr(e)))
+        self.ws.event_queue.post_threadsafe(run)
+        try:
+            reply["results"] = result.result()
+        except ControlError as e:
+            reply.update({"ok": False, "error": str(e)})
+        return reply
+
+    # Called by the main loop after every tick, sends the pin states to the subscribers if they changed
+    def publish_changes(self):
+        if(len(self.subscribers) == 0):
+            return
+        state = (self.ws.input_pin_states, self.ws.io.virtual_output_pin_state)
+        if(state == self.last_state):
+            return
+        self.last_state = state
+        event = {"event": "state", "t": clock.now(), "inputs": state[0], "outputs": state[1]}
+        with self.subscribers_lock:
+            for connection in self.subscribers:
+                connection.send(event)
+
+    def disconnected(self, connection):
+        with self.subscribers_lock:
+            if(connection in self.subscribers):
+                self.subscribers.remove(connection)
+
+# One client. Replies and state changes are queued and written by the connection's own thread, so a slow client never
+# holds up the main loop
+class ControlHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super(ControlHandler, self).setup()
+        self.outgoing = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_outgoing, name="control-writer", daemon=True)
+        self.writer.start()
+
+    def send(self, message):
+        self.outgoing.put(message)
+
+    def write_outgoing(self):
+        while(True):
+            message = self.outgoing.get()
+            if(message == None):
+                return
+            try:
+                self.wfile.write((json.dumps(message) + "\n").encode())
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def handle(self):
+        controller = self.server.controller
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    self.send({"id": None, "ok": False, "error": "bad json: " + str(e)})
+                    continue
+                if(type(request) != dict):
+                    self.send({"id": None, "ok": False, "error": "requests must be objects"})
+                    continue
+                self.send(controller.request(request, self))
+        finally:
+            controller.disconnected(self)
+            self.send(None)
+            self.writer.join()
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Serves the control api on a unix socket from a background thread, returns the server. A socket file left behind by
+# a previous run gets replaced
+def serve(ws, path):
+    if(os.path.exists(path)):
+        os.unlink(path)
+    server = ControlServer(path, ControlHandler)
+    server.controller = Controller(ws)
+    ws.control = server.controller
+    threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+    return server
+
+# Minimal client, one request per call
+class ControlClient():
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile("rwb")
+        self.next_id = 0
+
+    def request(self, commands):
+        self.next_id += 1
+        self.file.write((json.dumps({"id": self.next_id, "commands": commands}) + "\n").encode())
+        self.file.flush()
+        return self.read()
+
+    # Reads the next line (a reply or a state change)
+    def read(self):
+        line = self.file.readline()
+        if(line == b""):
+            raise EOFError("control socket closed")
+        return json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def main():
+    from main import CONTROL_SOCKET
+    command = sys.argv[1]
+    if(command == "set"):
+        commands = [{"op": "set", "pins": {sys.argv[2]: int(sys.argv[3])}}]
+    elif(command == "play"):
+        commands = [{"op": "play", "sound": sys.argv[2], "channel": int(sys.argv[3]) if len(sys.argv) > 3 else None}]
+    elif(command == "fire"):
+        commands = [{"op": "fire", "trigger": sys.argv[2]}]
+    elif(command == "state" or command == "watch"):
+        commands = [{"op": "state"}]
+    else:
+        print("Unknown command: " + command)
+        return
+    if(command == "watch"):
+        commands.append({"op": "subscribe"})
+    client = ControlClient(CONTROL_SOCKET)
+    start = time.perf_counter()
+    reply = client.request(commands)
+    print(json.dumps(reply) + " (" + "%.1f" % ((time.perf_counter() - start) * 1000) + "ms)")
+    while(command == "watch"):
+        print(json.dumps(client.read()))
+    client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Event scheduling for the main loop.
+# Events are kept in a heap ordered by (next_trigger_time, sequence number). The sequence number makes events with the
+# same trigger time fire in the order they were pushed, and means Event objects never have to be compared to each other.
+# Cancelled events are left in the heap and skipped when they reach the top; the heap gets compacted if cancelled events
+# start to make up most of it.
+import heapq
+import math
+import itertools
+import queue
+import threading
+import logging
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Don't bother compacting tiny heaps
+MIN_COMPACT_SIZE = 64
+
+class Event:
+    __slots__ = ("next_trigger_time", "action", "owner", "cancelled", "queued")
+
+    def __init__(self, next_trigger_time, action, owner=None):
+        self.next_trigger_time = next_trigger_time
+        self.action = action
+        # whoever scheduled this event (usually a Trigger) so all of its events can be cancelled at once
+        self.owner = owner
+        self.cancelled = False
+        # true while the event is sitting in a queue
+        self.queued = False
+
+# push returns the pushed event, which doubles as the handle that can be passed to cancel
+class EventQueue:
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.num_cancelled = 0
+        # owner -> set of that owner's pending events
+        self.owned_events = {}
+        # actions posted from other threads, these get run by the main loop
+        self.posted = queue.SimpleQueue()
+        self.wakeup = threading.Event()
+
+    def __len__(self):
+        return len(self.heap) - self.num_cancelled
+
+    def peek(self):
+        self.__discard_cancelled()
+        if(len(self.heap) < 1):
+            return None
+        return self.heap[0][2]
+
+    def pop(self):
+        self.__discard_cancelled()
+        event = heapq.heappop(self.heap)[2]
+        event.queued = False
+        self.__disown(event)
+        return event
+
+    # Pops every event that is due at time now, in the order they should fire
+    def pop_due(self, now):
+        due = []
+        while(True):
+            event = self.peek()
+            if(event == None or event.next_trigger_time > now):
+                return due
+            due.append(self.pop())
+
+    def push(self, event):
+        item = (event.next_trigger_time, next(self.sequence), event)
+        heapq.heappush(self.heap, item)
+        event.queued = True
+        if(event.owner != None):
+            self.owned_events.setdefault(event.owner, set()).add(event)
+        return event
+
+    # Cancels an event. Cancelling an event that has already been popped just marks it as cancelled
+    def cancel(self, event):
+        if(event.cancelled):
+            return
+        event.cancelled = True
+        if(not event.queued):
+            return
+        self.num_cancelled += 1
+        self.__disown(event)
+        if(len(self.heap) >= MIN_COMPACT_SIZE and self.num_cancelled * 2 > len(self.heap)):
+            self.__compact()
+
+    # Cancels every pending event pushed with the given owner
+    def cancel_owner(self, owner):
+        for event in list(self.owned_events.get(owner, ())):
+            self.cancel(event)
+
+    def pending_for_owner(self, owner):
+        return len(self.owned_events.get(owner, ()))
+
+    def __disown(self, event):
+        if(event.owner == None):
+            return
+        events = self.owned_events.get(event.owner)
+        if(events != None):
+            events.discard(event)
+            if(len(events) == 0):
+                del self.owned_events[event.owner]
+
+    def __discard_cancelled(self):
+        while(len(self.heap) > 0 and self.heap[0][2].cancelled):
+            heapq.heappop(self.heap)[2].queued = False
+            self.num_cancelled -= 1
+
+    def __compact(self):
+        for item in self.heap:
+            if(item[2].cancelled):
+                item[2].queued = False
+        self.heap = [item for item in self.heap if not item[2].cancelled]
+        heapq.heapify(self.heap)
+        self.num_cancelled = 0
+
+    # Can be called from any thread. The action will be run by the main loop as soon as possible
+    def post_threadsafe(self, action):
+        self.posted.put(action)
+        self.wakeup.set()
+
+    # Blocks until timeout passes or an action gets posted from another thread
+    def wait(self, timeout):
+        if(timeout > 0):
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def run_posted(self):
+        while(True):
+            try:
+                action = self.posted.get_nowait()
+            except queue.Empty:
+                return
+            action()
+
+# Keeps track of how late events fire compared to when they were scheduled
+class LatenessStats:
+    def __init__(self, name):
+        self.name = name
+        # same samples, but kept for the whole run as a histogram
+        self.histogram = metrics.histogram(name.lower() + "_lateness")
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squared = 0.0
+        self.max_lateness = 0.0
+
+    def record(self, scheduled_time, actual_time):
+        lateness = max(0.0, actual_time - scheduled_time)
+        self.histogram.record(lateness)
+        self.count += 1
+        self.total += lateness
+        self.total_squared += lateness * lateness
+        if(lateness > self.max_lateness):
+            self.max_lateness = lateness
+
+    def mean(self):
+        if(self.count < 1):
+            return 0.0
+        return self.total / self.count
+
+    def jitter(self):
+        # standard deviation of the lateness
+        if(self.count < 1):
+            return 0.0
+        mean = self.mean()
+        return math.sqrt(max(0.0, self.total_squared / self.count - mean * mean))
+
+    def report(self):
+        log.info("%s lateness over %d events: mean=%.2fms max=%.2fms jitter=%.2fms", self.name, self.count,
+                self.mean() * 1000, self.max_lateness * 1000, self.jitter() * 1000)
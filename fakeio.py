@@ -1,40 +1,140 @@
-from playsound import playsound
+# Stand in for TrainIo that doesn't touch any hardware, for running the layout logic on any machine.
+# Inputs are set with _debug_write_input_pin_state, and every output frame and sound request is recorded along with
+# the (clock module) time it happened, so a simulation can check what the layout did.
+# Like TrainIo this implements the train_sound_handler virtual_sound_channel_mgr interface.
+# Sounds go to a simple_sound_lib.FakeBackend unless a backend has already been set
+import clock
+import simple_sound_lib
+from train_sound_handler import SoundHandler
 
 PIN_ON = 1
 PIN_OFF = 0
-SOUND_CLICKING="/home/pi/trainenvironment/sounds/click.m4a"
-SOUND_SSSH="/home/pi/trainenvironment/sounds/sss.m4a"
 
 class FakeIo():
-    def __init__(self):
-        self.virtual_sound_channel = 0
-        self.input_pins = {}
-        self.output_pins = {}
-        for i in range(0, 16):
-            self.input_pins[i] = PIN_OFF
-            self.output_pins[i] = PIN_OFF
-    
+    def __init__(self, num_input_pins=16, num_output_pins=40, num_sound_channels=8, virtual_sound_channel_offset=32,
+            sound_handler=True):
+        self.num_input_pins = num_input_pins
+        self.num_output_pins = num_output_pins
+        self.num_sound_channels = num_sound_channels
+        self.virtual_sound_channel_offset = virtual_sound_channel_offset
+        self.input_pin_state = 0
+        self.last_input_word = 0
+        self.virtual_output_pin_state = 0
+        self.written_output_pin_state = 0
+        self.batch_depth = 0
+        self.output_dirty = False
+        self.frames_written = 0
+        self.frames_saved = 0
+        self.recorder = None
+        self.refresh_suspended = False
+        # list of (time, output pin state) for every frame that would have been written
+        self.frames = []
+        # list of (time, sound name, virtual channel) for every play_sound call
+        self.sounds = []
+        # pin -> the duty it was last dimmed to with set_output_duty
+        self.duties = {}
+        self.sound_handler = None
+        if(sound_handler):
+            if(simple_sound_lib.backend == None):
+                simple_sound_lib.set_backend(simple_sound_lib.FakeBackend())
+            self.sound_handler = SoundHandler(self, preload=False)
+
     def read_input_pin_state(self, pin):
-        return self.input_pins[pin]
-    
-    def write_output_pin_state(self, pin, state):
-        print("Write output pin " + str(pin) + " to state " + str(state))
-        self.output_pins[pin] = state
-    
-    def play_sound(self, filename):
-        if(filename != None):
-            playsound(filename, False)
+        return (self.input_pin_state >> pin) & 1
 
-    def _debug_write_input_pin_state(self, pin, state):
-        self.input_pins[pin] = state
+    def scan_input_pins(self):
+        word = self.input_pin_state
+        changed = word ^ self.last_input_word
+        self.last_input_word = word
+        return (word, changed)
 
-    def set_virtual_sound_channel(self, virtual_channel):
-        self.virtual_sound_channel = virtual_channel
+    def _debug_write_input_pin_state(self, pin, state):
+        if(state == PIN_ON):
+            self.input_pin_state |= 1 << pin
+        else:
+            self.input_pin_state &= ~(1 << pin)
 
     def get_all_input_pins(self):
-        return self.input_pins.keys()
+        return range(0, self.num_input_pins)
+
+    def get_all_output_pins(self):
+        return range(0, self.num_output_pins)
+
+    def get_output_pin_state(self, pin):
+        return (self.virtual_output_pin_state >> pin) & 1
+
+    def write_output_pin_state(self, pin, state):
+        assert pin >= 0 and pin < self.num_output_pins
+        if(state == PIN_ON):
+            self.virtual_output_pin_state |= 1 << pin
+        else:
+            self.virtual_output_pin_state &= ~(1 << pin)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    def write_output_pin_states(self, state):
+        self.virtual_output_pin_state = state & ((1 << self.num_output_pins) - 1)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    # There's no pwm here, a dimmed pin just counts as on
+    def set_output_duty(self, pin, duty):
+        self.duties[pin] = duty
+        self.write_output_pin_state(pin, PIN_ON if duty > 0 else PIN_OFF)
+
+    def begin_batch(self):
+        self.batch_depth += 1
+
+    def end_batch(self):
+        assert self.batch_depth > 0
+        self.batch_depth -= 1
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    def flush_output(self):
+        if(self.virtual_output_pin_state != self.written_output_pin_state):
+            self.frames.append((clock.now(), self.virtual_output_pin_state))
+            self.written_output_pin_state = self.virtual_output_pin_state
+            self.frames_written += 1
+            if(self.recorder != None):
+                self.recorder.record_frame(self.virtual_output_pin_state)
+        elif(self.output_dirty):
+            self.frames_saved += 1
+        self.output_dirty = False
+
+    # FakeIo has no pwm refreshers, this just keeps track of whether they would be running
+    def suspend_refresh(self):
+        self.refresh_suspended = True
+
+    def resume_refresh(self):
+        self.refresh_suspended = False
+
+    def play_sound(self, name, virtual_channel, priority=0):
+        self.sounds.append((clock.now(), name, virtual_channel))
+        if(self.recorder != None):
+            self.recorder.record_sound(name, virtual_channel, priority)
+        if(self.sound_handler != None):
+            self.sound_handler.play_sound(name, virtual_channel, priority)
+
+    def set_sound_dispatcher(self, dispatcher):
+        if(self.sound_handler != None):
+            self.sound_handler.set_dispatcher(dispatcher)
+
+    # Implement virtual sound channel manager interface
+
+    def enable_virtual_channel(self, val):
+        self.write_output_pin_state(self.virtual_sound_channel_offset + val, PIN_ON)
+
+    def disable_virtual_channel(self, val):
+        self.write_output_pin_state(self.virtual_sound_channel_offset + val, PIN_OFF)
+
+    def num_channels(self):
+        return self.num_sound_channels
 
+    # end implement interface
 
     def print_state(self):
-        print("virtualPins:" + str(self.output_pins))
-        print("virtual_channel:" + self.virtual_sound_channel)
+        print("virtualPins:" + bin(self.virtual_output_pin_state))
+        print("inputPins:" + bin(self.input_pin_state))
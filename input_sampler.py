@@ -0,0 +1,133 @@
+# Reads every input behind the parallel multiplexer in a single pass and debounces the result.
+# Input state is kept bit packed in an int (bit n = input pin n), the same way TrainIo keeps its output pin state.
+# The mux is walked in gray code order so only one select line changes between consecutive reads.
+from collections import deque
+import threading
+import time
+
+def gray_code(i):
+    return i ^ (i >> 1)
+
+# Yields the index of every set bit in mask, lowest first
+def iter_bits(mask):
+    while(mask):
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# Multiplexer wired to gpio pins. select_pins are ordered from least significant (SEL_0) up
+class GpioMux():
+    def __init__(self, gpio, select_pins, data_pin):
+        self.gpio = gpio
+        self.select_pins = select_pins
+        self.data_pin = data_pin
+
+    def num_select_bits(self):
+        return len(self.select_pins)
+
+    def write_select_bit(self, pos, bit):
+        self.gpio.output(self.select_pins[pos], bit)
+
+    def read(self):
+        return self.gpio.input(self.data_pin)
+
+# mux is expected to have 3 methods:
+#   num_select_bits() : int
+#   write_select_bit(pos, bit)
+#   read() : int
+class InputSampler():
+    def __init__(self, mux, num_inputs, debounce_samples=2, settle_time=0):
+        assert num_inputs > 0 and num_inputs <= (1 << mux.num_select_bits())
+        assert debounce_samples >= 1
+        self.mux = mux
+        self.num_inputs = num_inputs
+        self.mask = (1 << num_inputs) - 1
+        self.settle_time = settle_time
+        # every mux position in gray code order. Positions that aren't wired up still get selected on the way past
+        # (but not read), otherwise the step across them would change more than one select line
+        self.order = [gray_code(i) for i in range(1 << mux.num_select_bits())]
+        # the select value currently on the select lines, None until the first write so every line gets set
+        self.current_select = None
+        self.history = deque(maxlen=debounce_samples)
+        # debounced input state
+        self.state = 0
+
+    def select(self, val):
+        if(self.current_select == None):
+            changed = (1 << self.mux.num_select_bits()) - 1
+        else:
+            changed = val ^ self.current_select
+        for pos in iter_bits(changed):
+            self.mux.write_select_bit(pos, (val >> pos) & 1)
+        self.current_select = val
+
+    # Reads a single input without any debouncing
+    def read_pin(self, pos):
+        self.select(pos)
+        if(self.settle_time > 0):
+            time.sleep(self.settle_time)
+        return self.mux.read()
+
+    # Reads every input once without any debouncing
+    def sample_raw(self):
+        word = 0
+        for pos in self.order:
+            self.select(pos)
+            if(pos >= self.num_inputs):
+                continue
+            if(self.settle_time > 0):
+                time.sleep(self.settle_time)
+            if(self.mux.read()):
+                word |= 1 << pos
+        return word
+
+    # Takes one raw sample and updates the debounced state. A pin's debounced bit only flips once the last
+    # debounce_samples raw samples all agree on the new value.
+    # Returns a bitmask of the pins whose debounced value changed
+    def sample(self):
+        self.history.append(self.sample_raw())
+        if(len(self.history) < self.history.maxlen):
+            return 0
+        all_on = self.mask
+        all_off = self.mask
+        for word in self.history:
+            all_on &= word
+            all_off &= ~word
+        new_state = (self.state | all_on) & ~all_off
+        changed = new_state ^ self.state
+        self.state = new_state
+        return changed
+
+# Calls sample() every interval seconds on a background thread, and calls on_change(state, changed)
+# whenever a sample reports changed pins. sample() returns a tuple of (state, changed bitmask), e.g. TrainIo.scan_input_pins
+# on_change is called from the sampler thread so it must be thread safe.
+# If given, adjust_interval(interval) is asked for the interval to wait before every sample (i.e. to slow down while idle)
+class SamplerThread():
+    def __init__(self, sample, interval, on_change, adjust_interval=None):
+        self.sample = sample
+        self.interval = interval
+        self.on_change = on_change
+        self.adjust_interval = adjust_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="input-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        next_sample = time.monotonic()
+        while(not self.stopped.is_set()):
+            (state, changed) = self.sample()
+            if(changed):
+                self.on_change(state, changed)
+            next_sample += self.interval if self.adjust_interval == None else self.adjust_interval(self.interval)
+            delay = next_sample - time.monotonic()
+            if(delay < 0):
+                # sampling is taking longer than interval, don't try to catch up
+                next_sample = time.monotonic()
+            else:
+                self.stopped.wait(delay)
@@ -0,0 +1,141 @@
+# Loads the triggers for the layout from a json file, e.g.
+# {
+#     "triggers": [
+#         {"type": "timed_relay", "name": "bats", "trigger_pin": 0, "drive_pin": 0, "duration": 300, "cooldown": 5},
+#         {"type": "sound", "name": "saloon_music", "trigger_pin": 0, "cooldown": 20, "sound": "saloon"},
+#         {"type": "wigwag", "name": "possum", "trigger_pin": 0, "drive_pin": 0, "duration": 6, "cooldown": 10,
+#             "pulse_interval": 1, "pulse_duration": 0.3, "sound": "test", "sound_channel": 3}
+#     ]
+# }
+# Trigger types and their fields are listed in TRIGGER_FIELDS, sound, sound_channel and sound_priority are optional for
+# every type.
+# The whole file is validated before any triggers are created, so a broken file never leaves a half built layout behind.
+# Layout.watch keeps checking the file and swaps in the new triggers whenever it changes, without restarting.
+from os.path import getmtime
+import json
+import logging
+import clock
+import trainio
+from events import Event
+from train_sound_handler import ALL_SOUNDS
+from triggers import Trigger, TimedRelayTrigger, WigWagRelayTrigger
+
+log = logging.getLogger(__name__)
+
+# trigger type -> required numeric fields (besides trigger_pin)
+TRIGGER_FIELDS = {
+    "sound": ["cooldown"],
+    "timed_relay": ["drive_pin", "duration", "cooldown"],
+    "wigwag": ["drive_pin", "duration", "cooldown", "pulse_interval", "pulse_duration"],
+}
+
+class LayoutError(ValueError):
+    pass
+
+def check_pin(spec, field, limit):
+    pin = spec.get(field)
+    if(type(pin) != int or pin < 0 or pin >= limit):
+        raise LayoutError("trigger " + spec["name"] + ": " + field + " must be an integer from 0 to " + str(limit - 1))
+
+def check_spec(spec, num_input_pins, num_output_pins):
+    if(type(spec) != dict):
+        raise LayoutError("each trigger must be an object")
+    if(type(spec.get("name")) != str):
+        raise LayoutError("every trigger needs a name")
+    if(not spec.get("type") in TRIGGER_FIELDS):
+        raise LayoutError("trigger " + spec["name"] + ": type must be one of " + str(sorted(TRIGGER_FIELDS)))
+    check_pin(spec, "trigger_pin", num_input_pins)
+    for field in TRIGGER_FIELDS[spec["type"]]:
+        if(field == "drive_pin"):
+            check_pin(spec, field, num_output_pins)
+            sound_pins = range(trainio.VIRTUAL_SOUND_CHANNEL_OFFSET,
+                    trainio.VIRTUAL_SOUND_CHANNEL_OFFSET + trainio.NUM_VIRTUAL_SOUND_CHANNELS)
+            if(spec[field] in sound_pins):
+                raise LayoutError("trigger " + spec["name"] + ": " + field + " " + str(spec[field]) +
+                        " drives a virtual sound channel")
+        elif(type(spec.get(field)) not in (int, float) or spec[field] < 0):
+            raise LayoutError("trigger " + spec["name"] + ": " + field + " must be a number >= 0")
+    if(spec["type"] == "wigwag" and spec["pulse_duration"] >= spec["pulse_interval"]):
+        raise LayoutError("trigger " + spec["name"] + ": pulse_duration must be shorter than pulse_interval")
+    sound = spec.get("sound")
+    if(sound != None and not sound in ALL_SOUNDS):
+        raise LayoutError("trigger " + spec["name"] + ": unknown sound " + str(sound))
+    if(spec.get("sound_channel") != None):
+        check_pin(spec, "sound_channel", trainio.NUM_VIRTUAL_SOUND_CHANNELS)
+    if(type(spec.get("sound_priority", 0)) != int):
+        raise LayoutError("trigger " + spec["name"] + ": sound_priority must be an integer")
+
+# Validates the parsed json, returns the list of trigger specs
+def parse_layout(data, num_input_pins, num_output_pins):
+    if(type(data) != dict or type(data.get("triggers")) != list):
+        raise LayoutError("layout must be an object with a list of triggers")
+    names = set()
+    for spec in data["triggers"]:
+        check_spec(spec, num_input_pins, num_output_pins)
+        if(spec["name"] in names):
+            raise LayoutError("trigger name " + spec["name"] + " is used more than once")
+        names.add(spec["name"])
+    return data["triggers"]
+
+def build_trigger(spec, ws):
+    trigger = make_trigger(spec, ws)
+    trigger.sound_priority = spec.get("sound_priority", 0)
+    return trigger
+
+def make_trigger(spec, ws):
+    sound = spec.get("sound")
+    channel = spec.get("sound_channel")
+    if(spec["type"] == "sound"):
+        return Trigger(spec["name"], ws, spec["cooldown"], spec["trigger_pin"], sound, channel)
+    elif(spec["type"] == "timed_relay"):
+        return TimedRelayTrigger(spec["name"], ws, spec["duration"], spec["trigger_pin"], spec["drive_pin"],
+                spec["cooldown"], sound, channel)
+    return WigWagRelayTrigger(spec["name"], ws, spec["duration"], spec["trigger_pin"], spec["drive_pin"],
+            spec["cooldown"], spec["pulse_interval"], spec["pulse_duration"], sound, channel)
+
+class Layout():
+    def __init__(self, filename, ws):
+        self.filename = filename
+        self.ws = ws
+        self.triggers = []
+        self.mtime = None
+
+    def read(self):
+        with open(self.filename) as f:
+            return parse_layout(json.load(f), self.ws.num_input_pins, self.ws.num_output_pins)
+
+    # Loads the layout, raising LayoutError (or OSError if the file can't be read) if it's no good
+    def load(self):
+        mtime = getmtime(self.filename)
+        self.replace_triggers(self.read())
+        self.mtime = mtime
+        log.info("Loaded layout %s with %d triggers", self.filename, len(self.triggers))
+
+    def replace_triggers(self, specs):
+        for trigger in self.triggers:
+            trigger.remove()
+        self.triggers = [build_trigger(spec, self.ws) for spec in specs]
+
+    # Reloads the layout if the file changed. If the new file is broken the current triggers are kept
+    def reload_if_changed(self):
+        try:
+            mtime = getmtime(self.filename)
+        except OSError as e:
+            log.warning("Not reloading layout %s: %s", self.filename, e)
+            return
+        if(mtime == self.mtime):
+            return
+        try:
+            self.load()
+        except (OSError, ValueError) as e:
+            # json.JSONDecodeError and LayoutError are both ValueErrors
+            log.warning("Not reloading layout %s: %s", self.filename, e)
+            # don't keep complaining about the same broken file
+            self.mtime = mtime
+
+    # Checks the layout file for changes every interval seconds from the event queue
+    def watch(self, interval):
+        def check():
+            self.reload_if_changed()
+            self.ws.event_queue.push(Event(clock.now() + interval, check, self))
+        self.ws.event_queue.push(Event(clock.now() + interval, check, self))
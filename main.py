@@ -1,185 +1,192 @@
-import time
-import heapq
+import sys
+import math
 import logging
+import clock
+import metrics
+import trainlog
 import trainio
+import async_runtime
+import layout_config
+import power
+import recorder
+import control
+import sound_cache
+from events import Event, EventQueue, LatenessStats
+from triggers import WorldState, Trigger, TimedRelayTrigger, WigWagRelayTrigger
+
+log = logging.getLogger(__name__)
 
 TICK_TIME = 0.1
 
-BAT_TRIGGER_PIN = 0
-BAT_RELAY_PIN = 0
-SALOON_TRIGGER_PIN = 0
-
-POSSUM_RELAY_PIN = 0
-RABBIT_RELAY_PIN = 1
-POSSUM_TRIGGER_PIN = 0
-RABBIT_TRIGGER_PIN = 1
-
-logging.basicConfig(level=logging.DEBUG)
-
-class Event:
-    def __init__(self, next_trigger_time, action):
-        self.next_trigger_time = next_trigger_time
-        self.action = action
-
-class EventQueue:
-    def __init__(self):
-        self.heap = []
-
-    def peek(self):
-        if(len(self.heap) < 1):
-            return None
-        return self.heap[0][1]
-    
-    def pop(self):
-        item = heapq.heappop(self.heap)
-        return item[1]
-
-    def push(self, event):
-        item = (event.next_trigger_time, event)
-        heapq.heappush(self.heap, item)
-
-class WorldState:
-    def __init__(self, event_queue, io):
-        self.input_change_subscribers = {}
-        self.event_queue = event_queue
-        self.input_pin_states = {}
-        self.io = io
-        for pin in io.get_all_input_pins():
-            self.input_change_subscribers[pin] = []
-
-    def get_current_pin_state(self, pin):
-        if pin in self.input_pin_states:
-            return self.input_pin_states[pin]
-        return 0
-
-    def write_pin_state(self, pin, state):
-        self.io.write_output_pin_state(pin, state)
-
-    def scan_inputs(self):
-        print("World state scanning all inputs")
-        updated_pins = []
-        for pin in self.io.get_all_input_pins():
-            new_state = self.io.read_input_pin_state(pin)
-            past_state = self.get_current_pin_state(pin)
-            if(new_state != past_state):
-                print("Found changed state for pin " + str(pin))
-                updated_pins.append(pin)
-            self.input_pin_states[pin] = new_state
-
-        for pin in updated_pins:
-            for subscriber in self.input_change_subscribers[pin]:
-                print("calling subscriber for pin " + str(pin))
-                subscriber()
-    
-    def subscribe_to_state_change(self, pin_index, subscriber):
-        self.input_change_subscribers[pin_index].append(subscriber)
-        
-class Trigger:
-    def __init__(self, name, worldstate, cooldown_duration, trigger_pin, sound_name, sound_channel):
-        self.worldstate = worldstate
-        self.name = name
-        self.on = False
-        self.cooldown_duration = cooldown_duration
-        self.cooloff = time.time()
-        self.trigger_pin = trigger_pin
-        self.sound_name = sound_name
-        self.sound_channel = sound_channel
-        self.subscribe_to_pin_state(trigger_pin)
-    
-    def fire_trigger(self):
-        print("Trigger invoked for trigger " + self.name)
-        if(self.worldstate.get_current_pin_state(self.trigger_pin) == trainio.PIN_ON and not self.on and time.time() >= self.cooloff):
-            print("Trigger running for trigger " + self.name)
-            self.trigger_impl()
-            self.cooloff = time.time() + self.cooldown_duration
-            if(self.sound_name != None):
-                print("Trigger playing sound for trigger " + self.name)
-                self.worldstate.io.play_sound(self.sound_name, self.sound_channel)
-    
-    def trigger_impl(self):
-        pass
-
-    def end_impl(self):
-        pass
-
-    def end(self):
-        self.on = False
-        self.end_impl()
-
-    def subscribe_to_pin_state(self, pin_index):
-        self.worldstate.subscribe_to_state_change(pin_index, self.fire_trigger)
-
-class TimedRelayTrigger(Trigger):
-    def __init__(self, name, worldstate, duration, trigger_pin, drive_pin, cooldown_duration, sound, sound_channel):
-        super(TimedRelayTrigger, self).__init__(name, worldstate, cooldown_duration, trigger_pin, sound, sound_channel)
-        self.duration = duration
-        self.drive_pin = drive_pin
-
-    def start(self):
-        self.worldstate.write_pin_state(self.drive_pin, trainio.PIN_ON)
-        self.on = True
-
-    def end_impl(self):
-        self.worldstate.write_pin_state(self.drive_pin, trainio.PIN_OFF)
-
-    def trigger_impl(self):
-        self.worldstate.event_queue.push(Event(time.time(), self.start ) )
-        self.worldstate.event_queue.push(Event(time.time() + self.duration, self.end ) )
-
-class WigWagRelayTrigger(Trigger):
-    def __init__(self, name, worldstate, duration, trigger_pin, drive_pin, cooldown_duration, pulse_interval, pulse_duration, sound):
-        super(WigWagRelayTrigger, self).__init__(name, worldstate, cooldown_duration, trigger_pin, sound)
-        self.duration = duration
-        self.drive_pin = drive_pin
-        self.pulse_duration = pulse_duration
-        self.pulse_interval = pulse_interval
-    
-    def reschedule(self):
-        if(time.time() < self.end_at):
-            self.worldstate.event_queue.push(Event(time.time(), self.do_on) )
-            self.worldstate.event_queue.push(Event(time.time() + self.pulse_duration, self.do_off) )
-            self.worldstate.event_queue.push(Event(time.time() + self.pulse_interval, self.reschedule) )
-        else:
-            self.end()
-    
-    def do_on(self):
-        self.worldstate.write_pin_state(self.drive_pin, trainio.PIN_ON)
-
-    def do_off(self):
-        self.worldstate.write_pin_state(self.drive_pin, trainio.PIN_OFF)
-
-    def end_impl(self):
-        self.do_off()
-
-    def trigger_impl(self):
-        self.end_at = time.time() + self.duration
-        self.reschedule()
+# How often inputs are scanned when running the event driven scheduler
+SCAN_INTERVAL = TICK_TIME
+
+# If true, the main loop sleeps until the next event deadline or input scan instead of polling every TICK_TIME
+EVENT_DRIVEN_SCHEDULER = True
+
+# If true, inputs are sampled on a background thread and changes are posted to the main loop as they happen
+# instead of being scanned by the main loop every SCAN_INTERVAL
+INPUT_SAMPLER_THREAD = True
+
+# How often the background sampler thread samples the inputs
+INPUT_SAMPLE_INTERVAL = 0.002
+
+# How often (in seconds) the event lateness statistics get reported
+LATENESS_REPORT_INTERVAL = 60
+
+# Describes the triggers in the layout (see layout_config for the format)
+LAYOUT_FILE = "layout.json"
+
+# How often the layout file is checked for changes
+LAYOUT_RELOAD_INTERVAL = 2
+
+# Where input changes, output frames and sounds get recorded to when started with "record" (see replay.py)
+RECORD_FILE = "logs/record.bin"
+
+# Port on localhost the metrics get served on (curl localhost:8787), 0 to turn it off
+METRICS_PORT = 8787
+
+# Unix socket the control api is served on (see control.py), None to turn it off
+CONTROL_SOCKET = "control.sock"
+
+QUEUE_DEPTH = metrics.gauge("event_queue_depth")
 
 def main():
-    print("Starting main")
-    io = trainio.TrainIo()
+    trainlog.setup()
+    log.info("Starting main")
+    ws = setup(trainio.TrainIo())
+    if("record" in sys.argv[1:]):
+        recorder.attach(ws, RECORD_FILE)
+    run(ws)
+
+# Creates the world state and all of the triggers for the layout
+def setup(io):
     eq = EventQueue()
     ws = WorldState(eq, io)
-    trig = TimedRelayTrigger("bats", ws, 300, BAT_TRIGGER_PIN, BAT_RELAY_PIN, 5, None, None)
-    trig = Trigger("saloon_music", ws, 20, SALOON_TRIGGER_PIN, "saloon", None)
-    #trig = WigWagRelayTrigger("possum", ws, 6, POSSUM_TRIGGER_PIN, POSSUM_RELAY_PIN, 10, 1, .3, trainio.SOUND_CLICKING)
-    #trig = TimedRelayTrigger("rabbit", ws, 3, RABBIT_TRIGGER_PIN, RABBIT_RELAY_PIN, 5, trainio.SOUND_SSSH)
-
-    #eq.push(Event(time.time() + 1, lambda : setPinState(trainio.PIN_ON)))
-    #eq.push(Event(time.time() + 4, lambda : setPinState(trainio.PIN_OFF)))
+    io.set_sound_dispatcher(eq.post_threadsafe)
+    ws.layout = layout_config.Layout(LAYOUT_FILE, ws)
+    ws.layout.load()
+    ws.layout.watch(LAYOUT_RELOAD_INTERVAL)
+    power.PowerScheduler(ws)
+    return ws
+
+def run(ws):
+    eq = ws.event_queue
+    stats = LatenessStats("Event")
+    if(METRICS_PORT > 0):
+        try:
+            metrics.serve(METRICS_PORT)
+        except OSError as e:
+            log.warning("Not serving metrics: %s", e)
+    if(CONTROL_SOCKET != None):
+        try:
+            control.serve(ws, CONTROL_SOCKET)
+        except OSError as e:
+            log.warning("Not serving the control api: %s", e)
+    if("asyncio" in sys.argv[1:]):
+        async_runtime.run(ws, stats, lambda: report_stats(ws, stats), LATENESS_REPORT_INTERVAL)
+        return
+    scan = True
+    if(INPUT_SAMPLER_THREAD and not "scan" in sys.argv[1:]):
+        ws.start_sampler_thread(INPUT_SAMPLE_INTERVAL)
+        scan = False
+    if(EVENT_DRIVEN_SCHEDULER and not "polling" in sys.argv[1:]):
+        run_event_driven(ws, eq, stats, scan)
+    else:
+        run_polling(ws, eq, stats, scan)
+
+def report_startup_time():
+    uptime = clock.process_uptime()
+    if(uptime != None):
+        log.info("First tick reached %.3fs after process launch", uptime)
+
+def report_stats(ws, stats):
+    stats.report()
+    ws.input_latency.report()
+    log.info("Output frames written=%d saved=%d", ws.io.frames_written, ws.io.frames_saved)
+    if(ws.io.sound_handler != None):
+        ws.io.sound_handler.report()
+    if(sound_cache.cache != None):
+        sound_cache.cache.report()
+    if(ws.power != None):
+        ws.power.report()
+    log.info("Metrics:\n%s", metrics.dump())
+
+# Runs every event whose deadline has passed, including any that become due while running them
+def run_due_events(eq, stats):
+    due = eq.pop_due(clock.now())
+    while(len(due) > 0):
+        for event in due:
+            if(event.cancelled):
+                # cancelled by an earlier event in the same batch
+                continue
+            log.debug("Popped an action")
+            stats.record(event.next_trigger_time, clock.now())
+            event.action()
+        due = eq.pop_due(clock.now())
+
+# Runs a single scheduler tick. All output pin changes made during the tick are batched
+# so that at most one frame gets written to the shift registers
+def run_tick(ws, eq, stats, scan):
+    ws.io.begin_batch()
+    try:
+        eq.run_posted()
+        if(scan):
+            ws.scan_inputs()
+        run_due_events(eq, stats)
+        QUEUE_DEPTH.set(len(eq))
+    finally:
+        ws.io.end_batch()
+    if(ws.control != None):
+        ws.control.publish_changes()
+
+# How often to scan the inputs, which is less often while the layout is idle (see power.py)
+def scan_interval(ws, interval):
+    if(ws.power == None):
+        return interval
+    return ws.power.scan_interval(interval)
+
+# Original scheduler: wake up every TICK_TIME, scan inputs and run whatever events are due
+def run_polling(ws, eq, stats, scan):
     total_ticks=0
+    next_report = clock.now() + LATENESS_REPORT_INTERVAL
     while(True):
-        time.sleep(TICK_TIME)
-        print("Running tick " + str(total_ticks))
+        clock.sleep(scan_interval(ws, TICK_TIME))
+        log.debug("Running tick %d", total_ticks)
         total_ticks+=1
-        ws.scan_inputs()
+        run_tick(ws, eq, stats, scan)
+        if(total_ticks == 1):
+            report_startup_time()
+        if(clock.now() >= next_report):
+            report_stats(ws, stats)
+            next_report = clock.now() + LATENESS_REPORT_INTERVAL
+
+# Event driven scheduler: sleep until either the next event is due, the next input scan is due or an action
+# gets posted from another thread (i.e. the input sampler thread), whichever comes first
+# if scan is False, the inputs are never scanned from the main loop
+def run_event_driven(ws, eq, stats, scan):
+    next_scan = clock.now() if scan else math.inf
+    next_report = clock.now() + LATENESS_REPORT_INTERVAL
+    first_tick = True
+    while(True):
+        scan_now = clock.now() >= next_scan
+        if(scan_now):
+            next_scan += scan_interval(ws, SCAN_INTERVAL)
+            if(next_scan < clock.now()):
+                # scanning fell behind (e.g. slow serial writes), don't try to catch up with back to back scans
+                next_scan = clock.now() + scan_interval(ws, SCAN_INTERVAL)
+        run_tick(ws, eq, stats, scan_now)
+        if(first_tick):
+            report_startup_time()
+            first_tick = False
+        if(clock.now() >= next_report):
+            report_stats(ws, stats)
+            next_report = clock.now() + LATENESS_REPORT_INTERVAL
+        deadline = min(next_scan, next_report)
         next_event = eq.peek()
-        while(next_event and next_event.next_trigger_time <= time.time()):
-            eq.pop()
-            print("Popped an action")
-            next_event.action()
-            next_event = eq.peek()
-
+        if(next_event and next_event.next_trigger_time < deadline):
+            deadline = next_event.next_trigger_time
+        eq.wait(deadline - clock.now())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+# Lightweight instrumentation for the hot paths.
+# Histograms have a fixed number of power of two buckets (bucket n counts samples from 2^(n-1) up to 2^n microseconds)
+# so recording a sample is a couple of integer operations and never allocates. Each histogram is only ever written from
+# one thread, so no locking is needed; readers (the dump and the http endpoint) may see a sample half recorded, which
+# is fine for monitoring.
+# Everything can be read as a compact text dump, either printed periodically or served over http on localhost.
+from array import array
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+
+NUM_BUCKETS = 32
+
+# Set to False to turn all recording into a no-op
+ENABLED = True
+
+class Histogram():
+    def __init__(self, name):
+        self.name = name
+        self.buckets = array("L", [0] * NUM_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max_value = 0.0
+
+    # value is in seconds
+    def record(self, value):
+        if(not ENABLED):
+            return
+        bucket = int(value * 1000000).bit_length()
+        if(bucket >= NUM_BUCKETS):
+            bucket = NUM_BUCKETS - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        if(value > self.max_value):
+            self.max_value = value
+
+    # Returns an upper bound (in seconds) of the given percentile (0-100)
+    def percentile(self, p):
+        if(self.count < 1):
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for bucket in range(NUM_BUCKETS):
+            seen += self.buckets[bucket]
+            if(seen >= target):
+                return min((1 << bucket) / 1000000.0, self.max_value)
+        return self.max_value
+
+    def mean(self):
+        if(self.count < 1):
+            return 0.0
+        return self.total / self.count
+
+    def dump(self):
+        return (self.name + " count=" + str(self.count) + " mean=" + "%.3f" % (self.mean() * 1000) + "ms p50<=" +
+                "%.3f" % (self.percentile(50) * 1000) + "ms p99<=" + "%.3f" % (self.percentile(99) * 1000) + "ms max=" +
+                "%.3f" % (self.max_value * 1000) + "ms")
+
+class Gauge():
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.max_value = 0
+
+    def set(self, value):
+        if(not ENABLED):
+            return
+        self.value = value
+        if(value > self.max_value):
+            self.max_value = value
+
+    def dump(self):
+        return self.name + " value=" + str(self.value) + " max=" + str(self.max_value)
+
+# name -> Histogram or Gauge
+registry = {}
+registry_lock = threading.Lock()
+
+def histogram(name):
+    with registry_lock:
+        if(not name in registry):
+            registry[name] = Histogram(name)
+        return registry[name]
+
+def gauge(name):
+    with registry_lock:
+        if(not name in registry):
+            registry[name] = Gauge(name)
+        return registry[name]
+
+# Times a block of code into the named histogram
+#   with metrics.timer(SCAN_HISTOGRAM):
+class timer():
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hist.record(time.perf_counter() - self.start)
+
+def dump():
+    with registry_lock:
+        metrics = list(registry.values())
+    return "\n".join(metric.dump() for metric in sorted(metrics, key=lambda metric: metric.name))
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = (dump() + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # don't print a line for every request
+        pass
+
+# Serves the dump over http (i.e. curl localhost:8787) from a background thread, returns the server
+def serve(port, host="127.0.0.1"):
+    server = HTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
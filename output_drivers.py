@@ -0,0 +1,138 @@
+# Output drivers push the virtual output pin image out to the daisy chained serial to parallel shift registers.
+# Every driver implements:
+#   write_frame(data) : shifts the lowest num_bits bits of data out (most significant bit first) and latches them.
+#                       data is bytes, big endian, (num_bits + 7) // 8 long, so bit n of the chain is
+#                       data[-1 - n // 8] & (1 << (n % 8))
+# The drivers don't import RPi.GPIO themselves, the gpio module is passed in so that they can be used (and benchmarked)
+# on a machine without any GPIO hardware
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# I accidentally bought all LOW_TRIGGER relays, so invert everything and keep the logic the same
+INVERT_TABLE = bytes(255 - i for i in range(256))
+
+def invert_frame(data):
+    return data.translate(INVERT_TABLE)
+
+# BYTE_BITS[b] is the bits of byte b, most significant first
+BYTE_BITS = [tuple((b >> (7 - i)) & 1 for i in range(8)) for b in range(256)]
+
+def frame_bytes(num_bits):
+    return (num_bits + 7) // 8
+
+# Clocks every bit out by hand, sleeping between each clock edge
+class BitBangDriver():
+    def __init__(self, gpio, ser, srclk, rclk, num_bits, clock, invert=True):
+        self.gpio = gpio
+        self.ser = ser
+        self.srclk = srclk
+        self.rclk = rclk
+        self.num_bits = num_bits
+        self.clock = clock
+        self.invert = invert
+        # padding bits at the front of the first byte that aren't part of the chain
+        self.num_padding_bits = frame_bytes(num_bits) * 8 - num_bits
+
+    def write_frame(self, data):
+        if(self.invert):
+            data = invert_frame(data)
+        # checked once per frame so that the bit level trace costs nothing when it's off
+        trace = log.isEnabledFor(logging.DEBUG)
+        self.gpio.output(self.rclk, self.gpio.LOW)
+        skip = self.num_padding_bits
+        for byte in data:
+            for bit in BYTE_BITS[byte]:
+                if(skip > 0):
+                    skip -= 1
+                    continue
+                if(trace):
+                    log.debug("Writing serial output data: %d", bit)
+                self.write_bit(bit)
+        time.sleep(self.clock)
+        self.gpio.output(self.rclk, self.gpio.HIGH)
+
+    # Writes a single serial bit to the SER pin
+    def write_bit(self, bit):
+        self.gpio.output(self.srclk, self.gpio.LOW)
+        time.sleep(self.clock)
+        self.gpio.output(self.ser, bit)
+        time.sleep(self.clock)
+        self.gpio.output(self.srclk, self.gpio.HIGH)
+        time.sleep(self.clock)
+
+# Pushes the whole frame out in a single bulk transfer using the hardware SPI peripheral.
+# This requires SER to be wired to MOSI and SRCLK to be wired to SCLK, RCLK is still toggled through gpio.
+# spi is anything with an xfer2(list_of_bytes) method, if it's not given a spidev device gets opened
+class SpiDriver():
+    def __init__(self, gpio, rclk, num_bits, bus=0, device=0, speed_hz=1000000, spi=None, invert=True):
+        if(spi == None):
+            import spidev
+            spi = spidev.SpiDev()
+            spi.open(bus, device)
+            spi.max_speed_hz = speed_hz
+            spi.mode = 0
+        self.gpio = gpio
+        self.spi = spi
+        self.rclk = rclk
+        self.num_bits = num_bits
+        self.invert = invert
+
+    def write_frame(self, data):
+        # any padding bits at the front of the first byte just fall off the end of the chain
+        if(self.invert):
+            data = invert_frame(data)
+        self.gpio.output(self.rclk, self.gpio.LOW)
+        self.spi.xfer2(list(data))
+        self.gpio.output(self.rclk, self.gpio.HIGH)
+
+# Records every frame along with when it was written and how long writing it took.
+# If inner is given, frames are also passed through to it so that this can be used to measure a real driver
+class FakeDriver():
+    def __init__(self, inner=None, max_records=10000):
+        self.inner = inner
+        self.max_records = max_records
+        self.frames = []  # list of (start_time, duration, data)
+        self.num_frames = 0
+        self.total_duration = 0.0
+
+    def write_frame(self, data):
+        start = time.monotonic()
+        if(self.inner != None):
+            self.inner.write_frame(data)
+        duration = time.monotonic() - start
+        self.num_frames += 1
+        self.total_duration += duration
+        if(len(self.frames) < self.max_records):
+            self.frames.append((start, duration, data))
+
+    def last_frame(self):
+        if(len(self.frames) < 1):
+            return None
+        return self.frames[-1][2]
+
+    def frames_per_second(self):
+        if(self.total_duration <= 0):
+            return float("inf")
+        return self.num_frames / self.total_duration
+
+# Stand in for RPi.GPIO / spidev so that drivers can be exercised on a plain linux box
+class NullGpio():
+    LOW = 0
+    HIGH = 1
+    OUT = 0
+    IN = 1
+
+    def setup(self, pin, direction):
+        pass
+
+    def output(self, pin, val):
+        pass
+
+    def input(self, pin):
+        return 0
+
+class NullSpi():
+    def xfer2(self, data):
+        return data
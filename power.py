@@ -0,0 +1,169 @@
+# Idles the layout while nobody is around. Once no input has changed for IDLE_AFTER seconds (CLOSED_IDLE_AFTER outside
+# the operating windows, when the room is closed) the layout goes idle:
+#   - triggers that are still on get ended, so their relays let go
+#   - the main loop scans the inputs every IDLE_SCAN_INTERVAL instead of every tick, and the input sampler thread
+#     (or the asyncio runtime's input task) samples them every IDLE_SAMPLE_INTERVAL instead of every few ms. They ask
+#     scan_interval and sample_interval how long to wait each time round, so nothing needs changing on the way in or out
+#   - the pwm refreshers stop
+#   - the warmed up sound players are let go of, and started again in the background on waking up
+# The next input change wakes everything back up straight away. With the sampler thread running (the default) it gets
+# noticed within IDLE_SAMPLE_INTERVAL, well inside one normal scan period, otherwise within IDLE_SCAN_INTERVAL.
+# The time it takes from noticing the change to being awake and the process cpu time used while awake and idle are
+# kept and reported with the other stats.
+import logging
+import time
+import clock
+import simple_sound_lib
+from events import Event, LatenessStats
+
+log = logging.getLogger(__name__)
+
+# Go idle after this long without any input changes
+IDLE_AFTER = 15 * 60
+
+# Times of day (local time, "HH:MM-HH:MM") the layout room is open, None if it always is. A window can run past
+# midnight, i.e. "18:00-02:00"
+OPERATING_WINDOWS = None
+
+# Outside the operating windows, go idle after this long without any input changes
+CLOSED_IDLE_AFTER = 60
+
+# How often the main loop scans the inputs (or ticks, with the polling scheduler) while idle
+IDLE_SCAN_INTERVAL = 0.5
+
+# How often the input sampler thread samples the inputs while idle, which is the longest it takes to notice an input
+# change. Keep it below main.SCAN_INTERVAL so the layout is awake again within one normal scan period
+IDLE_SAMPLE_INTERVAL = 0.05
+
+# How often to check whether it's time to go idle
+IDLE_CHECK_INTERVAL = 10
+
+# If true, triggers that are still on when the layout goes idle get ended
+IDLE_ENDS_TRIGGERS = True
+
+# "HH:MM" -> minutes since midnight
+def parse_time_of_day(text):
+    (hours, minutes) = text.strip().split(":")
+    if(int(hours) > 23 or int(minutes) > 59):
+        raise ValueError("Bad time of day: " + text)
+    return int(hours) * 60 + int(minutes)
+
+# Returns a list of (start, end) in minutes since midnight
+def parse_windows(windows):
+    parsed = []
+    for window in windows:
+        (start, end) = window.split("-")
+        parsed.append((parse_time_of_day(start), parse_time_of_day(end)))
+    return parsed
+
+# minute is minutes since midnight
+def in_windows(windows, minute):
+    for (start, end) in windows:
+        if(start <= end and start <= minute < end):
+            return True
+        if(start > end and (minute >= start or minute < end)):
+            return True
+    return False
+
+class PowerScheduler():
+    def __init__(self, worldstate, windows=OPERATING_WINDOWS):
+        self.worldstate = worldstate
+        self.windows = None if windows == None else parse_windows(windows)
+        self.idle = False
+        self.last_input = clock.now()
+        self.num_idles = 0
+        # from noticing an input change to being awake again
+        self.wake_latency = LatenessStats("Wake")
+        # wall and process cpu time spent awake and idle
+        self.seconds = {False: 0.0, True: 0.0}
+        self.cpu_seconds = {False: 0.0, True: 0.0}
+        self.mode_started = (time.monotonic(), time.process_time())
+        worldstate.power = self
+        self.schedule_check()
+
+    def is_open(self):
+        if(self.windows == None):
+            return True
+        now = time.localtime()
+        return in_windows(self.windows, now.tm_hour * 60 + now.tm_min)
+
+    def idle_after(self):
+        return IDLE_AFTER if self.is_open() else CLOSED_IDLE_AFTER
+
+    # Scan interval to use instead of interval while idle
+    def scan_interval(self, interval):
+        if(self.idle):
+            return max(interval, IDLE_SCAN_INTERVAL)
+        return interval
+
+    # Same for the input sampler
+    def sample_interval(self, interval):
+        if(self.idle):
+            return max(interval, IDLE_SAMPLE_INTERVAL)
+        return interval
+
+    def schedule_check(self):
+        self.worldstate.event_queue.push(Event(clock.now() + IDLE_CHECK_INTERVAL, self.check, self))
+
+    def check(self):
+        if(self.idle):
+            return
+        if(clock.now() - self.last_input >= self.idle_after()):
+            self.sleep()
+        else:
+            self.schedule_check()
+
+    def input_changed(self, detected_at):
+        self.last_input = clock.now()
+        if(self.idle):
+            self.wake(detected_at)
+
+    def sleep(self):
+        log.info("No input changes for %.0fs, going idle", clock.now() - self.last_input)
+        self.__switch_mode(True)
+        self.num_idles += 1
+        ws = self.worldstate
+        if(IDLE_ENDS_TRIGGERS):
+            for trigger in list(ws.trigger_table.triggers):
+                if(trigger != None and trigger.on):
+                    trigger.end()
+        ws.io.suspend_refresh()
+        simple_sound_lib.release_backend()
+
+    def wake(self, detected_at):
+        self.__switch_mode(False)
+        ws = self.worldstate
+        ws.io.resume_refresh()
+        self.wake_latency.record(detected_at, clock.now())
+        log.info("Input changed, waking up")
+        self.schedule_check()
+        # before whatever woke the layout gets to play a sound
+        simple_sound_lib.warm_up_backend()
+
+    def __switch_mode(self, idle):
+        self.__account()
+        self.idle = idle
+
+    def __account(self):
+        (started, cpu_started) = self.mode_started
+        self.mode_started = (time.monotonic(), time.process_time())
+        self.seconds[self.idle] += self.mode_started[0] - started
+        self.cpu_seconds[self.idle] += self.mode_started[1] - cpu_started
+
+    # Fraction of a cpu used while awake or idle
+    def cpu_load(self, idle):
+        if(self.seconds[idle] <= 0):
+            return 0.0
+        return self.cpu_seconds[idle] / self.seconds[idle]
+
+    # Cpu seconds the idle time would have cost at the awake load, less what it did cost
+    def cpu_saved(self):
+        return self.seconds[True] * self.cpu_load(False) - self.cpu_seconds[True]
+
+    def report(self):
+        self.__account()
+        total = self.seconds[False] + self.seconds[True]
+        log.info("Power: idle %.0f%% of %.0fs (%d times), cpu load %.1f%% awake / %.1f%% idle, saved about %.1f cpu seconds",
+                self.seconds[True] / max(total, 1e-9) * 100, total, self.num_idles, self.cpu_load(False) * 100,
+                self.cpu_load(True) * 100, self.cpu_saved())
+        self.wake_latency.report()
@@ -0,0 +1,72 @@
+# Software PWM (dimming) for the shift register outputs, using binary code modulation.
+# A pin's brightness is a level from 0 to 2^bits - 1. Bit k of every pin's level makes up bit plane k, and plane k is
+# shown for unit * 2^k seconds, so over one cycle of all the planes a pin is on for level / (2^bits - 1) of the time.
+# That only takes bits frames per cycle (instead of 2^bits for plain PWM), which is what makes it possible to shift
+# them out fast enough. The planes are worked out whenever the pins change, the refresher thread just keeps shifting
+# the current ones out.
+# This needs a fast output driver (spi), the sleeping bitbang driver takes longer to write one frame than a whole cycle.
+import threading
+import time
+from events import LatenessStats
+
+PWM_BITS = 4
+# how long the least significant plane is shown for, a whole cycle takes unit * (2^bits - 1)
+PWM_UNIT = 0.0005
+
+def duty_level(duty, bits=PWM_BITS):
+    assert duty >= 0 and duty <= 1
+    return int(round(duty * ((1 << bits) - 1)))
+
+# base is the chain's frame for the pins that are simply on or off, levels is a list of (byte, mask, level) for the
+# pins being dimmed. Returns the list of bit planes, least significant first
+def make_planes(base, levels, bits=PWM_BITS):
+    planes = [bytearray(base) for k in range(bits)]
+    for (byte, mask, level) in levels:
+        for k in range(bits):
+            if((level >> k) & 1):
+                planes[k][byte] |= mask
+            else:
+                planes[k][byte] &= ~mask
+    return [bytes(plane) for plane in planes]
+
+# Keeps writing the bit planes to a single chain's driver on its own thread
+# Each chain's refresher needs its own name, since the name picks the lateness histogram and histograms are only ever
+# written from one thread
+class BcmRefresher():
+    def __init__(self, driver, planes, unit=PWM_UNIT, name="PWM"):
+        self.driver = driver
+        self.planes = planes
+        self.unit = unit
+        self.cycles = 0
+        # how late each plane gets written compared to when it should have been
+        self.lateness = LatenessStats(name)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name.lower() + "-refresh", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    # Can be called from any thread, the new planes are picked up at the start of the next cycle
+    def set_planes(self, planes):
+        self.planes = planes
+
+    def run(self):
+        next_plane = time.monotonic()
+        while(not self.stopped.is_set()):
+            planes = self.planes
+            for k in range(len(planes)):
+                now = time.monotonic()
+                self.lateness.record(next_plane, now)
+                self.driver.write_frame(planes[k])
+                next_plane += self.unit * (1 << k)
+                delay = next_plane - time.monotonic()
+                if(delay > 0):
+                    time.sleep(delay)
+                elif(delay < -self.unit * (1 << len(planes))):
+                    # more than a whole cycle behind, don't try to catch up
+                    next_plane = time.monotonic()
+            self.cycles += 1
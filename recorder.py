@@ -0,0 +1,132 @@
+# Records what the layout sees and does to a compact append only binary file, so a busy day can be replayed later
+# (see replay.py).
+# The file starts with a header, followed by records that each have a fixed size header
+#   kind (1 byte), time (double, clock.now()), payload length (2 bytes)
+# and then the payload:
+#   SESSION : nothing, written every time a Recorder opens the file (times are only comparable within a session)
+#   INPUT   : the input pin state and the bitmask of changed pins, each as num_input_bytes little endian bytes
+#   FRAME   : the output pin state that got written, as num_output_bytes little endian bytes
+#   SOUND   : virtual channel (-1 for none) and priority as 2 signed shorts, then the sound name in utf-8
+import atexit
+import os
+import struct
+import threading
+import clock
+from events import Event
+
+MAGIC = b"TRAINREC"
+FILE_HEADER = struct.Struct("<8sHH")
+RECORD_HEADER = struct.Struct("<BdH")
+SOUND_HEADER = struct.Struct("<hh")
+
+# How often the recording gets flushed to disk, at most this much is lost if the layout gets killed
+FLUSH_INTERVAL = 5
+
+SESSION = 0
+INPUT = 1
+FRAME = 2
+SOUND = 3
+
+class RecordError(ValueError):
+    pass
+
+def int_bytes(val, num_bytes):
+    return val.to_bytes(num_bytes, "little")
+
+class Recorder():
+    def __init__(self, filename, num_input_pins, num_output_pins):
+        self.num_input_bytes = (num_input_pins + 7) // 8
+        self.num_output_bytes = (num_output_pins + 7) // 8
+        # records come from the main loop and (with the asyncio runtime) the output thread
+        self.lock = threading.Lock()
+        new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if(not new_file):
+            check_header(filename, num_input_pins, num_output_pins)
+        self.file = open(filename, "ab")
+        if(new_file):
+            self.file.write(FILE_HEADER.pack(MAGIC, num_input_pins, num_output_pins))
+        self.write(SESSION, clock.now(), b"")
+
+    def write(self, kind, t, payload):
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(kind, t, len(payload)))
+            self.file.write(payload)
+
+    def record_input(self, t, state, changed):
+        self.write(INPUT, t, int_bytes(state, self.num_input_bytes) + int_bytes(changed, self.num_input_bytes))
+
+    def record_frame(self, state):
+        self.write(FRAME, clock.now(), int_bytes(state, self.num_output_bytes))
+
+    def record_sound(self, name, virtual_channel, priority):
+        channel = -1 if virtual_channel == None else virtual_channel
+        self.write(SOUND, clock.now(), SOUND_HEADER.pack(channel, priority) + name.encode())
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def check_header(filename, num_input_pins, num_output_pins):
+    with open(filename, "rb") as f:
+        (magic, inputs, outputs) = read_header(f)
+    if(inputs != num_input_pins or outputs != num_output_pins):
+        raise RecordError(filename + " was recorded with " + str(inputs) + " inputs and " + str(outputs) + " outputs")
+
+def read_header(f):
+    data = f.read(FILE_HEADER.size)
+    if(len(data) < FILE_HEADER.size or FILE_HEADER.unpack(data)[0] != MAGIC):
+        raise RecordError("not a recording")
+    return FILE_HEADER.unpack(data)
+
+# Reads a recording, returns (num_input_pins, num_output_pins, sessions) where sessions is a list of lists of records,
+# each starting with the session's own record:
+#   (SESSION, t)
+#   (INPUT, t, state, changed)
+#   (FRAME, t, state)
+#   (SOUND, t, name, virtual_channel, priority)
+# A record cut short at the end of the file (i.e. the recorder was killed part way through writing it) is ignored
+def read_records(filename):
+    with open(filename, "rb") as f:
+        (magic, num_input_pins, num_output_pins) = read_header(f)
+        data = f.read()
+    sessions = []
+    pos = 0
+    while(pos + RECORD_HEADER.size <= len(data)):
+        (kind, t, length) = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if(pos + length > len(data)):
+            break
+        payload = data[pos:pos + length]
+        pos += length
+        if(kind == SESSION):
+            sessions.append([(SESSION, t)])
+        elif(len(sessions) < 1):
+            raise RecordError("record before the first session")
+        elif(kind == INPUT):
+            half = length // 2
+            sessions[-1].append((INPUT, t, int.from_bytes(payload[:half], "little"), int.from_bytes(payload[half:], "little")))
+        elif(kind == FRAME):
+            sessions[-1].append((FRAME, t, int.from_bytes(payload, "little")))
+        elif(kind == SOUND):
+            (channel, priority) = SOUND_HEADER.unpack_from(payload)
+            name = payload[SOUND_HEADER.size:].decode()
+            sessions[-1].append((SOUND, t, name, None if channel < 0 else channel, priority))
+        else:
+            raise RecordError("unknown record kind " + str(kind))
+    return (num_input_pins, num_output_pins, sessions)
+
+# Starts recording everything the world state and its io do
+def attach(ws, filename):
+    recorder = Recorder(filename, ws.num_input_pins, ws.num_output_pins)
+    ws.recorder = recorder
+    ws.io.recorder = recorder
+    atexit.register(recorder.close)
+    def flush():
+        recorder.flush()
+        ws.event_queue.push(Event(clock.now() + FLUSH_INTERVAL, flush, recorder))
+    ws.event_queue.push(Event(clock.now() + FLUSH_INTERVAL, flush, recorder))
+    return recorder
@@ -0,0 +1,123 @@
+# Replays a recording made with "python3 main.py record" (see recorder.py) through the layout on a FakeIo, to load test
+# the trigger path offline and to check that it still does the same thing.
+# usage: python3 replay.py <recording> [speed] [layout file] [session]
+#   speed   : max (as fast as possible, the default), or how many times faster than recorded to replay, i.e. 1 or 100
+#   session : which session in the recording to replay, defaults to the last one
+# Reports how fast the replay went, how far behind the recording it fell (when paced) and any output frames or sounds
+# that differ from what was recorded. The virtual sound channel pins are left out of the frame comparison since they
+# depend on how long the sounds really played for.
+import json
+import sys
+import time
+import recorder
+import trainio
+from events import LatenessStats
+from input_sampler import iter_bits
+from main import LAYOUT_FILE
+from simulation import Simulation
+
+# How long after the last record the replay keeps running, so that trailing events (i.e. relays turning off) happen
+REPLAY_TAIL = 10
+
+# Drops the sound channel pins and any frames that don't change anything once they're gone
+def comparable_frames(frames, mask):
+    result = []
+    last = 0
+    for (t, state) in frames:
+        state &= mask
+        if(state != last):
+            result.append((t, state))
+            last = state
+    return result
+
+class ReplayResult():
+    def __init__(self):
+        self.num_inputs = 0
+        self.elapsed = 0.0
+        self.ticks = 0
+        # how far behind the recording's (scaled) timing each input got applied
+        self.lag = LatenessStats("Replay")
+        self.frame_mismatches = 0
+        self.first_mismatch = None
+        self.max_frame_skew = 0.0
+        self.sound_mismatches = 0
+
+    def report(self):
+        print("replayed " + str(self.num_inputs) + " input changes in " + "%.3f" % self.elapsed + "s (" +
+                "%.0f" % (self.num_inputs / max(self.elapsed, 1e-9)) + " changes/sec, " +
+                "%.1f" % (self.elapsed / max(1, self.ticks) * 1e6) + "us per tick)")
+        if(self.lag.count > 0):
+            print("lag behind the recording: mean=" + "%.2f" % (self.lag.mean() * 1000) + "ms max=" +
+                    "%.2f" % (self.lag.max_lateness * 1000) + "ms")
+        if(self.frame_mismatches == 0 and self.sound_mismatches == 0):
+            print("no divergence, largest frame time difference " + "%.1f" % (self.max_frame_skew * 1000) + "ms")
+        else:
+            print("DIVERGED: " + str(self.frame_mismatches) + " output frames and " + str(self.sound_mismatches) +
+                    " sounds differ, first frame difference at " + "%.3f" % self.first_mismatch + "s")
+
+# records is one session from recorder.read_records, speed is None for as fast as possible
+def replay(records, num_input_pins, num_output_pins, specs, speed=None):
+    result = ReplayResult()
+    inputs = [record for record in records if record[0] == recorder.INPUT]
+    # times are replayed relative to when the recording session started
+    t0 = records[0][1]
+    sim = Simulation(num_input_pins, num_output_pins)
+    try:
+        sim.load_layout(specs)
+        start = time.monotonic()
+        for (kind, t, state, changed) in inputs:
+            at = t - t0
+            if(speed != None):
+                due = start + at / speed
+                delay = due - time.monotonic()
+                if(delay > 0):
+                    time.sleep(delay)
+            for pin in iter_bits(changed):
+                sim.set_input(pin, (state >> pin) & 1, at)
+            sim.run_until(at)
+            if(speed != None):
+                result.lag.record(due, time.monotonic())
+        sim.run_until(records[-1][1] - t0 + REPLAY_TAIL)
+        result.elapsed = time.monotonic() - start
+    finally:
+        sim.close()
+    result.num_inputs = len(inputs)
+    result.ticks = sim.ticks
+    compare(result, records, t0, sim)
+    return result
+
+def compare(result, records, t0, sim):
+    mask = ~trainio.SOUND_CHANNEL_PINS
+    recorded = comparable_frames([(record[1] - t0, record[2]) for record in records if record[0] == recorder.FRAME], mask)
+    replayed = comparable_frames(sim.io.frames, mask)
+    for i in range(max(len(recorded), len(replayed))):
+        if(i >= len(recorded) or i >= len(replayed) or recorded[i][1] != replayed[i][1]):
+            result.frame_mismatches += 1
+            if(result.first_mismatch == None):
+                result.first_mismatch = (recorded[i] if i < len(recorded) else replayed[i])[0]
+        else:
+            result.max_frame_skew = max(result.max_frame_skew, abs(recorded[i][0] - replayed[i][0]))
+    recorded_sounds = [(record[2], record[3]) for record in records if record[0] == recorder.SOUND]
+    replayed_sounds = [(name, channel) for (t, name, channel) in sim.io.sounds]
+    for i in range(max(len(recorded_sounds), len(replayed_sounds))):
+        if(i >= len(recorded_sounds) or i >= len(replayed_sounds) or recorded_sounds[i] != replayed_sounds[i]):
+            result.sound_mismatches += 1
+
+def main():
+    filename = sys.argv[1]
+    speed = None
+    if(len(sys.argv) > 2 and sys.argv[2] != "max"):
+        speed = float(sys.argv[2])
+    layout_file = sys.argv[3] if len(sys.argv) > 3 else LAYOUT_FILE
+    (num_input_pins, num_output_pins, sessions) = recorder.read_records(filename)
+    if(len(sessions) < 1):
+        print("No sessions in " + filename)
+        return
+    session = int(sys.argv[4]) if len(sys.argv) > 4 else len(sessions) - 1
+    with open(layout_file) as f:
+        specs = json.load(f)["triggers"]
+    print("Replaying session " + str(session) + " of " + str(len(sessions)) + " from " + filename + " against " + layout_file)
+    replay(sessions[session], num_input_pins, num_output_pins, specs, speed).report()
+
+if __name__ == "__main__":
+    main()
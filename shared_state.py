@@ -0,0 +1,130 @@
+# Pin images and message queues in shared memory, for passing state between the worker processes (see supervisor.py).
+# Both survive a worker being killed and restarted, since the memory belongs to the supervisor.
+#
+# Python has no memory fences, so these rely on every position (and sequence number) being a single aligned 8 byte
+# write that is only made after the data it covers has been written, with a lot of interpreter work in between.
+import pickle
+import struct
+import time
+from multiprocessing import shared_memory
+
+COUNTER = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+
+# A sequence number that stays odd this long belongs to a writer that got killed part way through a write
+DEAD_WRITER_TIME = 0.05
+
+# Opens the named shared memory segment, or creates it (size bytes, zeroed) if create is true
+def open_segment(name, size, create):
+    if(create):
+        return shared_memory.SharedMemory(name, create=True, size=size)
+    return shared_memory.SharedMemory(name)
+
+# A bit packed pin state (bit n = pin n) that one process writes and any process can read.
+# Writes are guarded by a sequence number that is odd while a write is in progress, so a reader never sees half of one.
+# The exception is a writer killed part way through a write: once the sequence number has been stuck on the same odd
+# value for DEAD_WRITER_TIME, readers give up waiting and take whatever was written, and the next write (i.e. by the
+# restarted writer) puts the sequence number right again
+class PinImage():
+    def __init__(self, name, num_pins, create=False):
+        self.num_bytes = (num_pins + 7) // 8
+        self.shm = open_segment(name, COUNTER.size + self.num_bytes, create)
+        self.buf = self.shm.buf
+
+    def get(self):
+        stuck_seq = None
+        stuck_since = None
+        while(True):
+            seq = COUNTER.unpack_from(self.buf, 0)[0]
+            data = bytes(self.buf[COUNTER.size:COUNTER.size + self.num_bytes])
+            if(seq % 2 == 0 and COUNTER.unpack_from(self.buf, 0)[0] == seq):
+                return int.from_bytes(data, "little")
+            if(seq != stuck_seq):
+                stuck_seq = seq
+                stuck_since = time.monotonic()
+            elif(seq % 2 == 1 and time.monotonic() - stuck_since >= DEAD_WRITER_TIME):
+                return int.from_bytes(data, "little")
+
+    # Only one process may write an image
+    def set(self, state):
+        seq = COUNTER.unpack_from(self.buf, 0)[0]
+        # a writer killed part way through a write leaves the sequence number odd, round it back up to even
+        seq += seq & 1
+        COUNTER.pack_into(self.buf, 0, seq + 1)
+        self.buf[COUNTER.size:COUNTER.size + self.num_bytes] = state.to_bytes(self.num_bytes, "little")
+        COUNTER.pack_into(self.buf, 0, seq + 2)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+# Single producer, single consumer queue of picklable messages in a ring of shared memory. Neither side ever waits for
+# the other: put returns False if the ring is full and get returns None if it's empty.
+# The header holds how many bytes have ever been written (head, only changed by the producer) and read (tail, only
+# changed by the consumer). Each message is its length followed by the pickled message, wrapping around the end
+class RingBuffer():
+    def __init__(self, name, capacity=65536, create=False):
+        self.capacity = capacity
+        self.shm = open_segment(name, 2 * COUNTER.size + capacity, create)
+        self.buf = self.shm.buf
+        self.data = self.buf[2 * COUNTER.size:]
+
+    def head(self):
+        return COUNTER.unpack_from(self.buf, 0)[0]
+
+    def tail(self):
+        return COUNTER.unpack_from(self.buf, COUNTER.size)[0]
+
+    def __len__(self):
+        return self.head() - self.tail()
+
+    def __write(self, pos, data):
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start:start + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+
+    def __read(self, pos, length):
+        start = pos % self.capacity
+        first = min(length, self.capacity - start)
+        return bytes(self.data[start:start + first]) + bytes(self.data[:length - first])
+
+    def put(self, message):
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        head = self.head()
+        if(head - self.tail() + LENGTH.size + len(payload) > self.capacity):
+            return False
+        self.__write(head, LENGTH.pack(len(payload)))
+        self.__write(head + LENGTH.size, payload)
+        COUNTER.pack_into(self.buf, 0, head + LENGTH.size + len(payload))
+        return True
+
+    def get(self):
+        tail = self.tail()
+        if(self.head() == tail):
+            return None
+        length = LENGTH.unpack(self.__read(tail, LENGTH.size))[0]
+        message = pickle.loads(self.__read(tail + LENGTH.size, length))
+        COUNTER.pack_into(self.buf, COUNTER.size, tail + LENGTH.size + length)
+        return message
+
+    # Returns every message waiting in the ring
+    def get_all(self):
+        messages = []
+        message = self.get()
+        while(message != None):
+            messages.append(message)
+            message = self.get()
+        return messages
+
+    def close(self):
+        self.data.release()
+        self.data = None
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -1,19 +1,310 @@
 import subprocess
+import threading
+import logging
 import time
+import sound_cache
+import metrics
+
+log = logging.getLogger(__name__)
 
 # This is a very thin wrapper around sox's play process and is only designed specifically for this raspbian system
 # you must have sox installed for this to work
+#
+# Sounds are played through a backend. Backends implement:
+#   play_file(filename) : returns a handle for the sound
+#   play_pcm(pcm) : plays raw audio in the sound_cache PCM format, returns a handle for the sound
+# and handles implement:
+#   is_finished() : bool
+#   stop()
+#   add_done_callback(callback) : callback() gets called (from a background thread) once the sound finishes or is
+#       stopped, or straight away if it already has
+#   requested_at : monotonic time play_file was called
+#   started_at : monotonic time the audio started flowing to the player, or None if the backend can't tell
+
+# Which backend get_backend creates (see make_backend)
+DEFAULT_BACKEND = "sox_pool"
+
+# Number of idle players the pool keeps warmed up
+SOX_POOL_SIZE = 2
+
+# Bytes fed to a pooled player per write
+FEED_CHUNK_SIZE = 16384
+
+# Arguments that tell play what kind of audio it is reading from stdin
+PIPE_ARGS = {
+    "mp3": ["-t", "mp3"],
+    "raw": ["-t", "raw", "-r", str(sound_cache.PCM_RATE), "-e", "signed-integer", "-b", str(sound_cache.PCM_BITS),
+            "-c", str(sound_cache.PCM_CHANNELS)],
+}
+
+def spawn_pipe_player(kind):
+    return subprocess.Popen(["play", "-q"] + PIPE_ARGS[kind] + ["-"], stdin=subprocess.PIPE)
+
+def file_chunks(filename):
+    with open(filename, "rb") as f:
+        chunk = f.read(FEED_CHUNK_SIZE)
+        while(len(chunk) > 0):
+            yield chunk
+            chunk = f.read(FEED_CHUNK_SIZE)
+
+def pcm_chunks(pcm):
+    view = memoryview(pcm)
+    for i in range(0, len(pcm), FEED_CHUNK_SIZE):
+        yield view[i:i + FEED_CHUNK_SIZE]
+
+# Writes chunks to the stdin of the handle's player on a background thread
+def start_feeding(handle, chunks):
+    threading.Thread(target=feed, args=(handle, chunks), daemon=True).start()
+
+def feed(handle, chunks):
+    stdin = handle.proc.stdin
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+            if(handle.started_at == None):
+                stdin.flush()
+                handle.started_at = time.monotonic()
+        stdin.close()
+    except (BrokenPipeError, ValueError):
+        # the player was stopped part way through
+        pass
+
+class DoneCallbacks():
+    def __init__(self):
+        self.done = False
+        self.done_callbacks = []
+        self.done_lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        with self.done_lock:
+            if(not self.done):
+                self.done_callbacks.append(callback)
+                return
+        callback()
+
+    def run_done_callbacks(self):
+        with self.done_lock:
+            if(self.done):
+                return
+            self.done = True
+            callbacks = self.done_callbacks
+            self.done_callbacks = []
+        for callback in callbacks:
+            callback()
+
+# Each handle has a reaper thread that waits for its play process to exit, so finished sounds are noticed straight away
+# instead of whenever somebody next polls them
+class SoxHandle(DoneCallbacks):
+    def __init__(self, proc, requested_at):
+        super(SoxHandle, self).__init__()
+        self.proc = proc
+        self.pid = proc.pid
+        self.requested_at = requested_at
+        self.started_at = None
+        threading.Thread(target=self.reap, name="sound-reaper", daemon=True).start()
+
+    def reap(self):
+        self.proc.wait()
+        self.run_done_callbacks()
+
+    def is_finished(self):
+        return self.proc.poll() != None
+
+    def stop(self):
+        if(self.is_finished()):
+            log.debug("sound already finished, doing nothing")
+        else:
+            log.debug("sound is in progress; killing its process")
+            self.proc.terminate()
+
+# Starts a new play process for every sound
+class SoxProcessBackend():
+    def play_file(self, filename):
+        requested_at = time.monotonic()
+        return SoxHandle(subprocess.Popen(["play", "-q", filename]), requested_at)
+
+    def play_pcm(self, pcm):
+        handle = SoxHandle(spawn_pipe_player("raw"), time.monotonic())
+        start_feeding(handle, pcm_chunks(pcm))
+        return handle
+
+# Keeps pools of play processes that are already started and waiting for audio on stdin, so playing a sound doesn't
+# have to pay for starting sox. The audio is fed to the player from a background thread and a replacement player is
+# started in the background as well. sox can't detect the type of audio on a pipe, so there is one pool for mp3 files
+# and one for raw (already decoded) audio. Any other kind of file goes through a freshly started process
+class SoxPoolBackend():
+    def __init__(self, pool_size=SOX_POOL_SIZE):
+        self.pool_size = pool_size
+        self.fallback = SoxProcessBackend()
+        self.lock = threading.Lock()
+        self.idle = {}
+        for kind in PIPE_ARGS:
+            self.idle[kind] = []
+            self.refill(kind)
+
+    def refill(self, kind):
+        with self.lock:
+            self.idle[kind] = [proc for proc in self.idle[kind] if proc.poll() == None]
+            missing = self.pool_size - len(self.idle[kind])
+        for i in range(missing):
+            proc = spawn_pipe_player(kind)
+            with self.lock:
+                self.idle[kind].append(proc)
+
+    def take_player(self, kind):
+        with self.lock:
+            while(len(self.idle[kind]) > 0):
+                proc = self.idle[kind].pop(0)
+                if(proc.poll() == None):
+                    return proc
+        return spawn_pipe_player(kind)
+
+    def play_chunks(self, kind, chunks):
+        requested_at = time.monotonic()
+        handle = SoxHandle(self.take_player(kind), requested_at)
+        start_feeding(handle, chunks)
+        threading.Thread(target=self.refill, args=(kind,), daemon=True).start()
+        return handle
+
+    def play_file(self, filename):
+        if(not filename.endswith(".mp3")):
+            return self.fallback.play_file(filename)
+        # long tracks get streamed straight from disk
+        return self.play_chunks("mp3", file_chunks(filename))
+
+    def play_pcm(self, pcm):
+        return self.play_chunks("raw", pcm_chunks(pcm))
+
+    def shutdown(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+            for kind in idle:
+                self.idle[kind] = []
+        for kind in idle:
+            for proc in idle[kind]:
+                proc.kill()
+
+class FakeHandle(DoneCallbacks):
+    def __init__(self, backend, filename, requested_at):
+        super(FakeHandle, self).__init__()
+        self.backend = backend
+        self.filename = filename
+        self.requested_at = requested_at
+        self.started_at = requested_at + backend.startup_delay
+        self.stopped = False
+        self.timer = threading.Timer(self.started_at + backend.duration - time.monotonic(), self.run_done_callbacks)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def is_finished(self):
+        return self.stopped or time.monotonic() >= self.started_at + self.backend.duration
+
+    def stop(self):
+        self.stopped = True
+        self.timer.cancel()
+        self.run_done_callbacks()
+
+# Doesn't play anything. Records each sound and the latency from the trigger to the (simulated) first sample
+class FakeBackend():
+    def __init__(self, duration=1.0, startup_delay=0.0):
+        self.duration = duration
+        self.startup_delay = startup_delay
+        self.played = []
+
+    def play_file(self, filename):
+        handle = FakeHandle(self, filename, time.monotonic())
+        self.played.append(handle)
+        return handle
+
+    def play_pcm(self, pcm):
+        return self.play_file(None)
+
+    def latencies(self):
+        return [handle.started_at - handle.requested_at for handle in self.played]
+
+def make_backend(name=DEFAULT_BACKEND):
+    if(name == "sox"):
+        return SoxProcessBackend()
+    elif(name == "sox_pool"):
+        return SoxPoolBackend()
+    elif(name == "fake"):
+        return FakeBackend()
+    raise ValueError("Unknown sound backend: " + str(name))
+
+backend = None
+
+# Returns the backend sounds are played through, creating it the first time
+def get_backend():
+    global backend
+    if(backend == None):
+        backend = make_backend()
+    return backend
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+backend_lock = threading.Lock()
+# the SoxProcessBackend sounds play through while warm_up_backend starts the real one
+stand_in = None
+# bumped whenever the backend gets released, so a backend that finishes starting after that gets thrown away
+backend_generation = 0
+
+# Lets go of the backend's warmed up players (i.e. while the layout is idle), until warm_up_backend (or the next sound)
+# starts a new one. Sounds that are still playing aren't affected. Backends without anything to let go of are kept
+def release_backend():
+    global backend, backend_generation
+    with backend_lock:
+        backend_generation += 1
+        released = backend
+        if(released == None or (released is not stand_in and not hasattr(released, "shutdown"))):
+            return
+        backend = None
+    if(hasattr(released, "shutdown")):
+        released.shutdown()
+
+# Starts the default backend again after release_backend, on a background thread so nothing waits for its players to
+# start. Until it's ready every sound starts its own player (SoxProcessBackend). Does nothing if there is a backend
+def warm_up_backend():
+    global backend, stand_in
+    with backend_lock:
+        if(backend != None):
+            return
+        stand_in = SoxProcessBackend()
+        backend = stand_in
+        generation = backend_generation
+    threading.Thread(target=start_backend, args=(generation,), name="sound-warm-up", daemon=True).start()
+
+def start_backend(generation):
+    global backend, stand_in
+    try:
+        started = make_backend()
+    except OSError as e:
+        log.warning("Couldn't start the sound players, each sound will start its own: %s", e)
+        return
+    with backend_lock:
+        if(generation == backend_generation and backend is stand_in):
+            backend = started
+            stand_in = None
+            return
+    # released or replaced while it was starting up
+    if(hasattr(started, "shutdown")):
+        started.shutdown()
+
+# how long it takes to get a sound started (spawning or handing off to a player)
+SPAWN_TIME = metrics.histogram("sound_spawn")
 
 def play_sound(filename):
-    return subprocess.Popen(["play","-q", filename])
+    with metrics.timer(SPAWN_TIME):
+        return get_backend().play_file(filename)
+
+def play_pcm(pcm):
+    with metrics.timer(SPAWN_TIME):
+        return get_backend().play_pcm(pcm)
 
 def stop_sound(proc_handle):
-    if(proc_handle.poll() == 0):
-        print("sound already finished, doing nothing")
-        return None
-    else:
-        print("sound is in progress; killing its process")
-        return subprocess.Popen(["kill", str(proc_handle.pid)])
+    proc_handle.stop()
 
 def is_finished(proc_handle):
-    return proc_handle.poll() == 0
+    return proc_handle.is_finished()
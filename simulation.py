@@ -0,0 +1,130 @@
+# Deterministic simulation of the layout on a virtual clock.
+# The real WorldState, triggers, EventQueue, SoundHandler and main.run_tick are driven by a FakeIo, but instead of
+# sleeping, the simulation jumps the clock straight to the next thing that happens (a scripted input change, an event
+# deadline or a sound finishing), so hours of layout time run in a fraction of a second.
+#
+#   sim = Simulation()
+#   sim.load_layout(specs)              # same format as the "triggers" list of layout.json
+#   sim.pulse(0, at=1.0, duration=0.5)  # scripted input waveforms
+#   sim.run_until(60)
+#   sim.io.frames, sim.io.sounds        # what the layout did
+import heapq
+import itertools
+import clock
+import main
+import simple_sound_lib
+import layout_config
+from events import EventQueue, LatenessStats
+from fakeio import FakeIo, PIN_ON, PIN_OFF
+from triggers import WorldState
+
+# Sound handle whose sound finishes when the simulation clock gets to it
+class SimSoundHandle(simple_sound_lib.DoneCallbacks):
+    def __init__(self, filename, started_at, duration):
+        super(SimSoundHandle, self).__init__()
+        self.filename = filename
+        self.requested_at = started_at
+        self.started_at = started_at
+        self.ends_at = started_at + duration
+
+    def is_finished(self):
+        return self.done or clock.now() >= self.ends_at
+
+    def stop(self):
+        self.run_done_callbacks()
+
+class SimSoundBackend():
+    def __init__(self, duration):
+        self.duration = duration
+        self.played = []
+        self.playing = []
+
+    def play_file(self, filename):
+        handle = SimSoundHandle(filename, clock.now(), self.duration)
+        self.played.append(handle)
+        self.playing.append(handle)
+        return handle
+
+    def play_pcm(self, pcm):
+        return self.play_file(None)
+
+    def next_finish_time(self):
+        if(len(self.playing) < 1):
+            return None
+        return min(handle.ends_at for handle in self.playing)
+
+    def finish_due(self, now):
+        finished = [handle for handle in self.playing if handle.done or handle.ends_at <= now]
+        self.playing = [handle for handle in self.playing if not handle in finished]
+        for handle in finished:
+            handle.run_done_callbacks()
+
+class Simulation():
+    def __init__(self, num_input_pins=16, num_output_pins=40, sound_duration=5.0):
+        self.clock = clock.SimClock()
+        self.previous_clock = clock.use_clock(self.clock)
+        self.sound_backend = SimSoundBackend(sound_duration)
+        self.previous_backend = simple_sound_lib.backend
+        simple_sound_lib.set_backend(self.sound_backend)
+        self.io = FakeIo(num_input_pins, num_output_pins)
+        self.eq = EventQueue()
+        self.ws = WorldState(self.eq, self.io)
+        self.io.set_sound_dispatcher(self.eq.post_threadsafe)
+        self.stats = LatenessStats("Event")
+        # heap of (time, sequence, pin, state) scripted input changes
+        self.inputs = []
+        self.sequence = itertools.count()
+        self.ticks = 0
+        self.triggers = []
+
+    # Puts the real clock and sound backend back
+    def close(self):
+        clock.use_clock(self.previous_clock)
+        simple_sound_lib.set_backend(self.previous_backend)
+
+    def load_layout(self, specs):
+        for spec in layout_config.parse_layout({"triggers": specs}, self.ws.num_input_pins, self.ws.num_output_pins):
+            self.triggers.append(layout_config.build_trigger(spec, self.ws))
+
+    def set_input(self, pin, state, at):
+        heapq.heappush(self.inputs, (at, next(self.sequence), pin, state))
+
+    # Scripts a single on pulse on the pin
+    def pulse(self, pin, at, duration):
+        self.set_input(pin, PIN_ON, at)
+        self.set_input(pin, PIN_OFF, at + duration)
+
+    # Scripts count pulses of high_time, one every period
+    def square_wave(self, pin, start, period, high_time, count):
+        for i in range(count):
+            self.pulse(pin, start + i * period, high_time)
+
+    def next_time(self):
+        times = []
+        if(len(self.inputs) > 0):
+            times.append(self.inputs[0][0])
+        next_event = self.eq.peek()
+        if(next_event != None):
+            times.append(next_event.next_trigger_time)
+        finish = self.sound_backend.next_finish_time()
+        if(finish != None):
+            times.append(finish)
+        if(len(times) < 1):
+            return None
+        return min(times)
+
+    # Runs everything that happens up to and including end_time, then leaves the clock at end_time
+    def run_until(self, end_time):
+        while(True):
+            t = self.next_time()
+            if(t == None or t > end_time):
+                break
+            self.clock.advance_to(t)
+            now = self.clock.now()
+            while(len(self.inputs) > 0 and self.inputs[0][0] <= now):
+                (at, seq, pin, state) = heapq.heappop(self.inputs)
+                self.io._debug_write_input_pin_state(pin, state)
+            self.sound_backend.finish_due(now)
+            main.run_tick(self.ws, self.eq, self.stats, True)
+            self.ticks += 1
+        self.clock.advance_to(end_time)
@@ -0,0 +1,97 @@
+# Cache of decoded (raw PCM) audio so that short, frequently played effects don't have to be read from the SD card and
+# decoded every time they play. Long tracks are never cached, they get streamed from disk by the sound backend instead.
+# The cache has a memory budget and evicts the least recently used clips when it goes over it.
+from collections import OrderedDict
+from os.path import getsize
+import subprocess
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Format all clips get decoded to. The sound backends play raw audio in this same format
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+PCM_BITS = 16
+
+# Total bytes of decoded audio the cache may hold
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# Files bigger than this (on disk) count as long tracks and are always streamed
+MAX_PRELOAD_FILE_BYTES = 256 * 1024
+
+# Decodes filename to raw PCM using sox, returns None if it can't be decoded
+def decode_file(filename):
+    try:
+        res = subprocess.run(["sox", filename, "-t", "raw", "-r", str(PCM_RATE), "-e", "signed-integer",
+                "-b", str(PCM_BITS), "-c", str(PCM_CHANNELS), "-"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        log.warning("Unable to decode %s: %s", filename, e)
+        return None
+    if(res.returncode != 0):
+        log.warning("Unable to decode %s, sox exited with %d", filename, res.returncode)
+        return None
+    return res.stdout
+
+class PcmCache():
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_file_bytes=MAX_PRELOAD_FILE_BYTES, decoder=decode_file):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.decoder = decoder
+        # filename -> pcm bytes, least recently used first
+        self.clips = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # clips get loaded from a background thread while the main loop reads them
+        self.lock = threading.Lock()
+
+    # Returns the decoded audio for filename, or None if it isn't cached. This never decodes anything
+    def get(self, filename):
+        with self.lock:
+            pcm = self.clips.get(filename)
+            if(pcm == None):
+                self.misses += 1
+                return None
+            self.clips.move_to_end(filename)
+            self.hits += 1
+            return pcm
+
+    # Decodes filename and adds it to the cache, unless it's a long track or already cached
+    # returns True if the clip is cached afterwards
+    def load(self, filename):
+        with self.lock:
+            if(filename in self.clips):
+                return True
+        if(getsize(filename) > self.max_file_bytes):
+            return False
+        pcm = self.decoder(filename)
+        if(pcm == None or len(pcm) > self.max_bytes):
+            return False
+        self.put(filename, pcm)
+        return True
+
+    def put(self, filename, pcm):
+        with self.lock:
+            if(filename in self.clips):
+                self.num_bytes -= len(self.clips.pop(filename))
+            self.clips[filename] = pcm
+            self.num_bytes += len(pcm)
+            while(self.num_bytes > self.max_bytes):
+                (evicted_name, evicted) = self.clips.popitem(last=False)
+                self.num_bytes -= len(evicted)
+                self.evictions += 1
+
+    def report(self):
+        log.info("PCM cache: %d clips, %d/%d bytes, hits=%d misses=%d evictions=%d", len(self.clips), self.num_bytes,
+                self.max_bytes, self.hits, self.misses, self.evictions)
+
+cache = None
+
+# Returns the cache shared by all sounds, creating it the first time
+def get_cache():
+    global cache
+    if(cache == None):
+        cache = PcmCache()
+    return cache
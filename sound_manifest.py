@@ -0,0 +1,85 @@
+# On disk cache of what is in each sound directory (file names, sizes, mtimes and durations), so that startup doesn't have
+# to list and stat every sound directory and run soxi on every file. A directory only gets rescanned when its mtime
+# changes (which happens whenever a file is added, removed or renamed in it).
+from os import listdir, replace, stat
+from os.path import isfile, join
+import json
+import logging
+import subprocess
+import threading
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = "sounds/manifest.json"
+
+# Returns the length of a sound file in seconds, or None if soxi can't tell
+def read_duration(filename):
+    try:
+        res = subprocess.run(["soxi", "-D", filename], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if(res.returncode == 0):
+            return float(res.stdout)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def scan_directory(dirname):
+    entries = []
+    for f in sorted(listdir(dirname)):
+        path = join(dirname, f)
+        if(not isfile(path)):
+            continue
+        st = stat(path)
+        entries.append({"name": f, "size": st.st_size, "mtime": st.st_mtime, "duration": read_duration(path)})
+    return entries
+
+class Manifest():
+    def __init__(self, filename=MANIFEST_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # dirname -> {"mtime": directory mtime, "files": [file entries]}
+        self.dirs = {}
+        self.dirty = False
+        try:
+            with open(filename) as f:
+                self.dirs = json.load(f)
+        except (OSError, ValueError):
+            # no manifest yet (or a broken one), everything gets rescanned
+            pass
+
+    # Returns the file entries for dirname, rescanning the directory if it changed since it was last scanned
+    def files(self, dirname):
+        mtime = stat(dirname).st_mtime
+        with self.lock:
+            entry = self.dirs.get(dirname)
+            if(entry != None and entry["mtime"] == mtime):
+                return entry["files"]
+        files = scan_directory(dirname)
+        with self.lock:
+            self.dirs[dirname] = {"mtime": mtime, "files": files}
+            self.dirty = True
+        return files
+
+    def save(self):
+        with self.lock:
+            if(not self.dirty):
+                return
+            data = json.dumps(self.dirs, indent=1, sort_keys=True)
+            self.dirty = False
+        tmp = self.filename + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+            replace(tmp, self.filename)
+        except OSError as e:
+            log.warning("Unable to save sound manifest %s: %s", self.filename, e)
+
+manifest = None
+manifest_lock = threading.Lock()
+
+# Returns the manifest shared by all sounds, loading it the first time
+def get_manifest():
+    global manifest
+    with manifest_lock:
+        if(manifest == None):
+            manifest = Manifest()
+        return manifest
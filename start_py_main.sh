@@ -1,7 +1,5 @@
-logsuffix=`date +%s`
-new_log_name="logs/app-${logsuffix}.log"
-#LOG_FILE=logs/app.log
-LOG_FILE=/dev/null
-echo "Rotating log file app.log to ${new_log_name}"
-mv logs/app.log "${new_log_name}"
-python3 main.py > $LOG_FILE 2>&1
+# main.py writes its own log to logs/app.log and rotates it by size (see trainlog.py),
+# stdout and stderr only get anything interesting if the process crashes
+LOG_FILE=logs/crash.log
+mkdir -p logs
+python3 main.py >> $LOG_FILE 2>&1
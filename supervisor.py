@@ -0,0 +1,350 @@
+# Runs the layout as three worker processes, so that a stuck shift register write or a slow sound launch can't hold up
+# everything else:
+#   io    : owns the TrainIo, samples the inputs and writes the output frames
+#   audio : owns the SoundHandler and the virtual sound channel pins
+#   logic : runs the WorldState, the triggers and the event loop (main.run) on a WorkerIo
+# Each worker publishes its pin state as an image in shared memory and sends every change over a ring buffer to the
+# worker that needs it (see shared_state.py):
+#   io -> logic    : input changes (time, state, changed)
+#   logic -> io    : output frames, without the sound channel pins (time, state)
+#   logic -> audio : sounds to play (time, name, virtual channel, priority)
+#   audio -> io    : sound channel pins (time, state)
+# The io worker writes the logic worker's pins and the audio worker's sound channel pins as one frame.
+#
+# Every worker keeps stamping its slot in the heartbeat array, and the supervisor restarts a worker that exits or
+# stops stamping for WORKER_TIMEOUT. A restarted worker picks up from the images, so the relays stay as they were:
+#   io    : writes the last frame that got written as its first frame, instead of turning everything off
+#   logic : holds the output pins that were on for RESTART_HOLD, since whatever was running them is gone
+#   audio : starts with nothing playing and the sound channels closed
+# Messages carry the time they were sent (time.monotonic is the same clock in every process) and the receiving worker
+# keeps lateness stats on them, which end up in its log (logs/<worker>.log) and metrics.
+#
+# usage: python3 supervisor.py [fake]
+#   fake : runs the io worker on a FakeIo, to try it out without the hardware
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import animation
+import clock
+import main as layout_main
+import metrics
+import trainio
+import trainlog
+from events import Event, EventQueue, LatenessStats
+from fakeio import FakeIo
+from shared_state import PinImage, RingBuffer
+from train_sound_handler import SoundHandler
+
+log = logging.getLogger(__name__)
+
+# Restart a worker that hasn't stamped its heartbeat for this long
+WORKER_TIMEOUT = 5
+
+# How long a newly started worker gets before its first heartbeat is due (spawning it and importing everything)
+WORKER_STARTUP_TIME = 10
+
+HEARTBEAT_INTERVAL = 0.5
+
+# How often the supervisor checks on the workers
+SUPERVISE_INTERVAL = 0.5
+
+# A worker that keeps failing waits RESTART_DELAY before its first restart, twice as long before the next one and so
+# on up to MAX_RESTART_DELAY. Once it has stayed up for RESTART_DELAY_RESET the delay starts over
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 60
+RESTART_DELAY_RESET = 60
+
+# How long a restarted logic worker keeps on the output pins that were on when it took over
+RESTART_HOLD = 10
+
+# How often the audio worker checks for sounds to play (finished sounds are handled straight away)
+AUDIO_POLL_INTERVAL = 0.005
+
+RING_SIZE = 65536
+
+# %s is the worker's name, or "supervisor"
+WORKER_LOG_FILE = "logs/%s.log"
+
+# heartbeat slots
+IO = 0
+AUDIO = 1
+LOGIC = 2
+
+# The images and rings the workers share
+class SharedState():
+    def __init__(self, prefix, num_input_pins, num_output_pins, create=False):
+        self.inputs = PinImage(prefix + "inputs", num_input_pins, create)
+        # what the logic worker wants the output pins to be
+        self.logic_outputs = PinImage(prefix + "logic_outputs", num_output_pins, create)
+        # the sound channel pins the audio worker wants
+        self.sound_outputs = PinImage(prefix + "sound_outputs", num_output_pins, create)
+        # the last frame the io worker wrote
+        self.outputs = PinImage(prefix + "outputs", num_output_pins, create)
+        self.input_changes = RingBuffer(prefix + "input_changes", RING_SIZE, create)
+        self.frames = RingBuffer(prefix + "frames", RING_SIZE, create)
+        self.sound_requests = RingBuffer(prefix + "sound_requests", RING_SIZE, create)
+        self.sound_channels = RingBuffer(prefix + "sound_channels", RING_SIZE, create)
+
+    def all(self):
+        return [self.inputs, self.logic_outputs, self.sound_outputs, self.outputs, self.input_changes, self.frames,
+                self.sound_requests, self.sound_channels]
+
+    def close(self):
+        for shared in self.all():
+            shared.close()
+
+    def unlink(self):
+        for shared in self.all():
+            shared.unlink()
+
+def report_every(interval, report):
+    next_report = [time.monotonic() + interval]
+    def check():
+        if(time.monotonic() >= next_report[0]):
+            report()
+            log.info("Metrics:\n%s", metrics.dump())
+            next_report[0] = time.monotonic() + interval
+    return check
+
+# io worker: scans the inputs and writes whatever the logic and audio workers want the outputs to be, every
+# INPUT_SAMPLE_INTERVAL
+def run_io(prefix, num_input_pins, num_output_pins, heartbeats, fake):
+    trainlog.setup(WORKER_LOG_FILE % "io")
+    shared = SharedState(prefix, num_input_pins, num_output_pins)
+    frame = shared.outputs.get()
+    if(fake):
+        io = FakeIo(num_input_pins, num_output_pins, sound_handler=False)
+        io.write_output_pin_states(frame)
+    else:
+        io = trainio.TrainIo(sound_handler=False, initial_output_state=frame)
+    log.info("io worker started with outputs %s", bin(frame))
+    frame_latency = LatenessStats("Io_frames")
+    channel_latency = LatenessStats("Io_sound_channels")
+    def report():
+        frame_latency.report()
+        channel_latency.report()
+        log.info("Output frames written=%d saved=%d", io.frames_written, io.frames_saved)
+    check_report = report_every(layout_main.LATENESS_REPORT_INTERVAL, report)
+    # input changes that haven't made it into the ring yet (if the logic worker isn't keeping up)
+    unsent = 0
+    next_scan = time.monotonic()
+    while(True):
+        heartbeats[IO] = time.monotonic()
+        (state, changed) = io.scan_input_pins()
+        unsent |= changed
+        if(unsent):
+            shared.inputs.set(state)
+            if(shared.input_changes.put((time.monotonic(), state, unsent))):
+                unsent = 0
+        for (t, logic_state) in shared.frames.get_all():
+            frame_latency.record(t, time.monotonic())
+        for (t, sound_state) in shared.sound_channels.get_all():
+            channel_latency.record(t, time.monotonic())
+        # the images always have the latest state, even if a ring was full
+        new_frame = ((shared.logic_outputs.get() & ~trainio.SOUND_CHANNEL_PINS) |
+                (shared.sound_outputs.get() & trainio.SOUND_CHANNEL_PINS))
+        if(new_frame != frame):
+            io.write_output_pin_states(new_frame)
+            shared.outputs.set(new_frame)
+            frame = new_frame
+        check_report()
+        next_scan += layout_main.INPUT_SAMPLE_INTERVAL
+        delay = next_scan - time.monotonic()
+        if(delay < 0):
+            next_scan = time.monotonic()
+        else:
+            time.sleep(delay)
+
+# The audio worker's virtual sound channel manager, publishing the channel pins to the io worker
+class AudioChannels():
+    def __init__(self, shared):
+        self.shared = shared
+        self.state = 0
+
+    def publish(self):
+        self.shared.sound_outputs.set(self.state)
+        self.shared.sound_channels.put((time.monotonic(), self.state))
+
+    def enable_virtual_channel(self, val):
+        self.state |= 1 << (trainio.VIRTUAL_SOUND_CHANNEL_OFFSET + val)
+        self.publish()
+
+    def disable_virtual_channel(self, val):
+        self.state &= ~(1 << (trainio.VIRTUAL_SOUND_CHANNEL_OFFSET + val))
+        self.publish()
+
+    def num_channels(self):
+        return trainio.NUM_VIRTUAL_SOUND_CHANNELS
+
+def run_audio(prefix, num_input_pins, num_output_pins, heartbeats):
+    trainlog.setup(WORKER_LOG_FILE % "audio")
+    shared = SharedState(prefix, num_input_pins, num_output_pins)
+    channels = AudioChannels(shared)
+    # close any channels the last audio worker left open
+    channels.publish()
+    handler = SoundHandler(channels)
+    # finished sounds get handled on this thread, like they do on the main loop in a single process
+    posted = EventQueue()
+    handler.set_dispatcher(posted.post_threadsafe)
+    log.info("audio worker started")
+    request_latency = LatenessStats("Audio_requests")
+    def report():
+        request_latency.report()
+        handler.report()
+    check_report = report_every(layout_main.LATENESS_REPORT_INTERVAL, report)
+    while(True):
+        heartbeats[AUDIO] = time.monotonic()
+        for (t, name, virtual_channel, priority) in shared.sound_requests.get_all():
+            request_latency.record(t, time.monotonic())
+            handler.play_sound(name, virtual_channel, priority)
+        posted.run_posted()
+        check_report()
+        posted.wait(AUDIO_POLL_INTERVAL)
+
+# What the logic worker's WorldState runs on. Input changes come from the io worker, and frames and sounds get sent
+# to the io and audio workers instead of being kept like a FakeIo does
+class WorkerIo(FakeIo):
+    def __init__(self, shared, num_input_pins, num_output_pins):
+        super(WorkerIo, self).__init__(num_input_pins, num_output_pins, trainio.NUM_VIRTUAL_SOUND_CHANNELS,
+                trainio.VIRTUAL_SOUND_CHANNEL_OFFSET, sound_handler=False)
+        self.shared = shared
+        self.input_pin_state = shared.inputs.get()
+        self.input_latency = LatenessStats("Logic_inputs")
+        # messages that didn't fit in a ring (frames still get through through the image)
+        self.num_dropped = 0
+
+    def scan_input_pins(self):
+        changed = 0
+        for (t, state, message_changed) in self.shared.input_changes.get_all():
+            self.input_latency.record(t, time.monotonic())
+            self.input_pin_state = state
+            changed |= message_changed
+        return (self.input_pin_state, changed)
+
+    def flush_output(self):
+        state = self.virtual_output_pin_state
+        if(state != self.written_output_pin_state):
+            self.shared.logic_outputs.set(state)
+            if(not self.shared.frames.put((time.monotonic(), state))):
+                self.num_dropped += 1
+            self.written_output_pin_state = state
+            self.frames_written += 1
+        elif(self.output_dirty):
+            self.frames_saved += 1
+        self.output_dirty = False
+
+    def play_sound(self, name, virtual_channel, priority=0):
+        if(not self.shared.sound_requests.put((time.monotonic(), name, virtual_channel, priority))):
+            log.warning("Dropping sound %s, the audio worker isn't keeping up", name)
+            self.num_dropped += 1
+
+def run_logic(prefix, num_input_pins, num_output_pins, heartbeats):
+    trainlog.setup(WORKER_LOG_FILE % "logic")
+    shared = SharedState(prefix, num_input_pins, num_output_pins)
+    io = WorkerIo(shared, num_input_pins, num_output_pins)
+    ws = layout_main.setup(io)
+    # start from the inputs as they are, so pins that are already on don't look like they just changed
+    ws.input_pin_states = io.input_pin_state
+    held = shared.outputs.get() & ~trainio.SOUND_CHANNEL_PINS
+    if(held != 0):
+        log.info("Holding outputs %s for %ds after a restart", bin(held), RESTART_HOLD)
+        ws.animator.start(animation.Timeline([0], [held], None, RESTART_HOLD))
+    log.info("logic worker started")
+    # stamped from the event loop, so a stuck loop stops the heartbeat
+    def heartbeat():
+        heartbeats[LOGIC] = time.monotonic()
+        ws.event_queue.push(Event(clock.now() + HEARTBEAT_INTERVAL, heartbeat))
+    heartbeat()
+    def report():
+        io.input_latency.report()
+        ws.event_queue.push(Event(clock.now() + layout_main.LATENESS_REPORT_INTERVAL, report))
+    ws.event_queue.push(Event(clock.now() + layout_main.LATENESS_REPORT_INTERVAL, report))
+    layout_main.run(ws)
+
+class Worker():
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.restarts = 0
+        self.started_at = None
+        # when the worker is due to be restarted, None while it's running
+        self.restart_at = None
+        self.restart_delay = RESTART_DELAY
+
+class Supervisor():
+    def __init__(self, fake=False):
+        self.prefix = "train" + str(os.getpid()) + "_"
+        num_input_pins = trainio.BOARD.num_input_pins
+        num_output_pins = trainio.BOARD.num_output_pins
+        self.shared = SharedState(self.prefix, num_input_pins, num_output_pins, create=True)
+        # spawned rather than forked, the supervisor has threads (logging) that a fork would copy mid flight
+        self.context = multiprocessing.get_context("spawn")
+        self.heartbeats = self.context.RawArray("d", 3)
+        args = (self.prefix, num_input_pins, num_output_pins, self.heartbeats)
+        self.workers = [Worker("io", run_io, args + (fake,)), Worker("audio", run_audio, args),
+                Worker("logic", run_logic, args)]
+
+    def start(self, index):
+        worker = self.workers[index]
+        self.heartbeats[index] = time.monotonic() + WORKER_STARTUP_TIME
+        worker.process = self.context.Process(target=worker.target, args=worker.args, name=worker.name, daemon=True)
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        log.info("Started %s worker pid %d", worker.name, worker.process.pid)
+
+    # Restarts any worker that exited or stopped responding, backing off if it keeps failing
+    def check(self):
+        now = time.monotonic()
+        for (index, worker) in enumerate(self.workers):
+            if(worker.restart_at != None):
+                if(now >= worker.restart_at):
+                    worker.restarts += 1
+                    log.info("Restarting %s worker (restart %d)", worker.name, worker.restarts)
+                    self.start(index)
+                continue
+            if(not worker.process.is_alive()):
+                log.warning("%s worker exited with code %s", worker.name, worker.process.exitcode)
+            elif(now - self.heartbeats[index] > WORKER_TIMEOUT):
+                log.warning("%s worker stopped responding, killing it", worker.name)
+                worker.process.kill()
+                worker.process.join()
+            else:
+                if(now - worker.started_at >= RESTART_DELAY_RESET):
+                    worker.restart_delay = RESTART_DELAY
+                continue
+            worker.restart_at = now + worker.restart_delay
+            log.info("Restarting %s worker in %.1fs", worker.name, worker.restart_delay)
+            worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def run(self):
+        for index in range(len(self.workers)):
+            self.start(index)
+        try:
+            while(True):
+                time.sleep(SUPERVISE_INTERVAL)
+                self.check()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            if(worker.process != None and worker.process.is_alive()):
+                worker.process.terminate()
+                worker.process.join()
+        self.shared.close()
+        self.shared.unlink()
+
+def main():
+    trainlog.setup(WORKER_LOG_FILE % "supervisor")
+    # turn a kill into an exit, so the workers get stopped and the shared memory removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    Supervisor("fake" in sys.argv[1:]).run()
+
+if __name__ == "__main__":
+    main()
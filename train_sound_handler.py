@@ -5,10 +5,18 @@
 # the caller can also stop sounds by name
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import clock
+import simple_sound_lib
+import sound_manifest
 from trainsound import Sound
 
+log = logging.getLogger(__name__)
+
 # logging.basicConfig(level=logging.DEBUG)
 # Globally define the sound names to Sound object mappings
+# Creating a Sound is cheap, its directory isn't read until it's first used or preloaded
 ALL_SOUNDS = {
     "test": Sound("sounds/test"),
     "test_left": Sound("sounds/test_left"),
@@ -19,59 +27,211 @@ ALL_SOUNDS = {
     "saloon": Sound("sounds/saloon")
 }
 
+# Number of sound directories loaded at once by preload_sounds
+PRELOAD_THREADS = 4
+
+# Loads every sound's directory listing and decodes its short clips, several directories at a time
+def preload_sounds():
+    with ThreadPoolExecutor(max_workers=PRELOAD_THREADS) as executor:
+        list(executor.map(lambda sound: sound.preload(), ALL_SOUNDS.values()))
+    sound_manifest.get_manifest().save()
+
+# Most requests that can wait in a virtual channel's queue, past that the lowest priority request gets dropped
+MAX_QUEUE_DEPTH = 4
+
+# Queued requests older than this are dropped instead of played, a sound a minute after the train went by is no use
+MAX_QUEUE_WAIT = 30
+
+# Virtual channels that can share the relay driven sound output. Every enabled virtual channel hears whatever is
+# playing, so only channels in the same group (i.e. speakers in the same scene) get to play at the same time, anything
+# for another group waits its turn (or preempts it, if it has a higher priority). None puts every channel in a group of
+# its own
+CHANNEL_GROUPS = None
+
+class SoundRequest():
+    def __init__(self, name, virtual_channel, priority, requested_at):
+        self.name = name
+        self.virtual_channel = virtual_channel
+        self.priority = priority
+        self.requested_at = requested_at
+
 class SoundHandler():
     # virtual_sound_channel_mgr is expected to have 2 methods:
     #   enable_virtual_channel(int)
     #   disable_virtual_channel(int)
     #   num_channels : int
-    def __init__(self, virtual_sound_channel_mgr):
+    def __init__(self, virtual_sound_channel_mgr, preload=True, channel_groups=CHANNEL_GROUPS):
         self.virtual_sound_channel_mgr = virtual_sound_channel_mgr
+        # start up the sound backend now so that the first sound doesn't have to wait for it
+        try:
+            simple_sound_lib.get_backend()
+        except OSError as e:
+            log.warning("Couldn't start the sound players, each sound will start its own: %s", e)
+            simple_sound_lib.set_backend(simple_sound_lib.SoxProcessBackend())
+        if(preload):
+            # decode the short clips in the background so startup isn't held up by it
+            threading.Thread(target=preload_sounds, name="sound-preload", daemon=True).start()
+        # sounds finish on a background thread, dispatcher(action) is used to get back onto the thread that owns
+        # the virtual channels. By default the action just runs straight away
+        self.dispatcher = lambda action: action()
         self.active_channels = []
+        self.queues = []
         for i in range(virtual_sound_channel_mgr.num_channels()):
-            self.active_channels.append([]) # list of currently in progress sounds in that channel
+            self.active_channels.append([]) # list of handles of the currently in progress sounds in that channel
+            self.queues.append([]) # requests waiting for the sound output, oldest first
+        if(channel_groups == None):
+            channel_groups = [[i] for i in range(virtual_sound_channel_mgr.num_channels())]
+        # virtual channel -> index of its group
+        self.channel_group = {}
+        for (group, channels) in enumerate(channel_groups):
+            for channel in channels:
+                self.channel_group[channel] = group
+        # handle -> (sound, request) for the sounds playing on virtual channels
+        self.playing = {}
+        self.num_played = 0
+        self.num_queued = 0
+        self.num_dropped = 0
+        self.num_preempted = 0
+
+    def set_dispatcher(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def in_use_channels(self):
+        return [i for i in range(len(self.active_channels)) if len(self.active_channels[i]) > 0]
+
+    # The channel group that has the sound output right now, None if nothing is playing on a virtual channel
+    def active_group(self):
+        for channel in self.in_use_channels():
+            return self.channel_group[channel]
+        return None
+
+    def playing_priority(self):
+        return max([request.priority for (sound, request) in self.playing.values()], default=0)
+
+    # Called (through the dispatcher) once a sound playing on a virtual channel finishes
+    def on_sound_finished(self, virtual_channel, handle):
+        if(not handle in self.playing):
+            # preempted, its channels have been dealt with already
+            return
+        active_channel_list = self.active_channels[virtual_channel]
+        if(handle in active_channel_list):
+            active_channel_list.remove(handle)
+            if(len(active_channel_list) == 0):
+                self.virtual_sound_channel_mgr.disable_virtual_channel(virtual_channel)
+                log.debug("Disabling virtual sound channel %d because all sounds completed on it", virtual_channel)
+        if(not any(handle in handles for handles in self.active_channels)):
+            self.playing.pop(handle, None)
+        if(self.active_group() == None):
+            self.start_queued()
 
     # Plays the given named sound on the specified virtual channel
-    # if the given sound is already in progress, this will do nothing
-    # if another virtual channel is already being used, the new channel will also be enabled but all active channels
-    # will play all sounds
+    # if the given sound is already in progress, the channel just gets added to it
     # if virtual_channel is set to None, this will not open any virtual channels (i.e. used for the other real channel that doesn't go through)
-    #   virtual channels
-
-    def cleanup_channels(self):
-        res = []
-        for i in range(len(self.active_channels)):
-            active_channel_list = self.active_channels[i]
-            # cut list down 
-            has_elements = len(active_channel_list) > 0
-            if has_elements:
-                active_channel_list[:] = [snd for snd in active_channel_list if snd.is_playing()]
-                if(len(active_channel_list) == 0):
-                    # means we did have elements but now we don't
-                    self.virtual_sound_channel_mgr.disable_virtual_channel(i)
-                    print("Disabling virtual sound channel " + str(i) + " because all sounds completed on it")
-                else:
-                    res.append(i)
-        return res
-                
-
-    def play_sound(self, name, virtual_channel):
-        print("play sound: " + name)
-        active_channels=self.cleanup_channels()
+    #   virtual channels) and the request is dropped if the sound is already playing
+    # If a different sound has the sound output, the request either preempts it (if priority is higher than
+    # everything playing) or waits in the channel's queue until the output is free
+    # The virtual channel gets disabled again as soon as the last sound on it finishes
+    def play_sound(self, name, virtual_channel, priority=0):
+        log.debug("play sound: %s", name)
         if(not name in ALL_SOUNDS):
-            print("Asked to play sound that doesn't exist in known sounds: " + name)
+            log.warning("Asked to play sound that doesn't exist in known sounds: %s", name)
             return
-        sound = ALL_SOUNDS[name]
         if(virtual_channel == None):
-            print("Playing sound on no virtual channel")
+            sound = ALL_SOUNDS[name]
+            if(sound.is_playing()):
+                log.debug("Dropping sound %s on no virtual channel, it's already playing", name)
+                self.num_dropped += 1
+                return
+            log.debug("Playing sound on no virtual channel")
             sound.play_next_sound()
+            self.num_played += 1
+            return
+        request = SoundRequest(name, virtual_channel, priority, clock.now())
+        active_group = self.active_group()
+        if(active_group == None):
+            self.start(request)
+        elif(active_group == self.channel_group[virtual_channel] and self.is_playing(name)):
+            self.start(request, join=True)
+        elif(priority > self.playing_priority()):
+            self.preempt()
+            self.start(request)
         else:
-            if(len(active_channels) > 0):
-                print("Playing sound on channel " + str(virtual_channel) + " but found sounds already in progress on channels " + str(active_channels))
-            self.virtual_sound_channel_mgr.enable_virtual_channel(virtual_channel)
-            sound.play_next_sound()
-            print("adding sound " + name + " to active virtual channel " + str(virtual_channel))
-            self.active_channels[virtual_channel].append(sound)
-            
+            self.enqueue(request)
+
+    # True if the named sound is playing on a virtual channel
+    def is_playing(self, name):
+        return any(request.name == name for (sound, request) in self.playing.values())
+
+    # Starts a new playback of the sound, or with join adds the channel to the one already playing.
+    # Returns False if the sound couldn't be started
+    def start(self, request, join=False):
+        sound = ALL_SOUNDS[request.name]
+        handle = sound.play_next_sound() if join else sound.play_new_sound()
+        if(handle == None):
+            return False
+        if(handle in self.active_channels[request.virtual_channel]):
+            return True
+        virtual_channel = request.virtual_channel
+        self.virtual_sound_channel_mgr.enable_virtual_channel(virtual_channel)
+        log.debug("adding sound %s to active virtual channel %d", request.name, virtual_channel)
+        self.active_channels[virtual_channel].append(handle)
+        if(not handle in self.playing):
+            self.num_played += 1
+            self.playing[handle] = (sound, request)
+        elif(self.playing[handle][1].priority < request.priority):
+            self.playing[handle] = (sound, request)
+        handle.add_done_callback(lambda: self.dispatcher(lambda: self.on_sound_finished(virtual_channel, handle)))
+        return True
+
+    # Stops everything playing on the virtual channels to make way for a more important sound. The channels are cleared
+    # before the sounds get stopped, so their done callbacks find nothing left to do
+    def preempt(self):
+        playing = self.playing
+        self.playing = {}
+        for channel in self.in_use_channels():
+            self.active_channels[channel] = []
+            self.virtual_sound_channel_mgr.disable_virtual_channel(channel)
+        for (handle, (sound, request)) in playing.items():
+            log.info("Preempting sound %s on virtual channel %d", request.name, request.virtual_channel)
+            self.num_preempted += 1
+            sound.stop_sound(handle)
+
+    def enqueue(self, request):
+        queue = self.queues[request.virtual_channel]
+        if(len(queue) >= MAX_QUEUE_DEPTH):
+            lowest = min(queue, key=lambda queued: queued.priority)
+            if(lowest.priority >= request.priority):
+                log.debug("Dropping sound %s, the queue for virtual channel %d is full", request.name, request.virtual_channel)
+                self.num_dropped += 1
+                return
+            queue.remove(lowest)
+            self.num_dropped += 1
+        log.debug("Queueing sound %s on virtual channel %d", request.name, request.virtual_channel)
+        queue.append(request)
+        self.num_queued += 1
+
+    # Gives the sound output to the most important (then oldest) queued request, the rest stay queued until it finishes
+    def start_queued(self):
+        now = clock.now()
+        while(True):
+            best = None
+            for queue in self.queues:
+                for request in list(queue):
+                    if(now - request.requested_at > MAX_QUEUE_WAIT):
+                        queue.remove(request)
+                        self.num_dropped += 1
+                    elif(best == None or (-request.priority, request.requested_at) < (-best.priority, best.requested_at)):
+                        best = request
+            if(best == None):
+                return
+            self.queues[best.virtual_channel].remove(best)
+            if(self.start(best)):
+                return
+
+    def report(self):
+        log.info("Sounds played=%d queued=%d dropped=%d preempted=%d", self.num_played, self.num_queued, self.num_dropped,
+                self.num_preempted)
+
 
 if __name__ == "__main__":
     # fake virtual sound chnl mgr
@@ -1,36 +1,47 @@
 from train_sound_handler import SoundHandler
-import RPi.GPIO as GPIO
+from output_drivers import BitBangDriver, SpiDriver, FakeDriver, frame_bytes
+from input_sampler import GpioMux, InputSampler
+import pwm
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 import logging
 import time
 import sys
 
+log = logging.getLogger(__name__)
+
 PIN_ON = 1
 PIN_OFF = 0
 CLOCK = 0.001
 
-GPIO.setmode(GPIO.BCM)
-
 # GPIO pin mappings
 SER = 4
-GPIO.setup(SER, GPIO.OUT)
 RCLK = 17
-GPIO.setup(RCLK, GPIO.OUT)
 SRCLK = 27
-GPIO.setup(SRCLK, GPIO.OUT)
 
 SEL_0 = 13
-GPIO.setup(SEL_0, GPIO.OUT)
 SEL_1 = 25
-GPIO.setup(SEL_1, GPIO.OUT)
 SEL_2 = 24
-GPIO.setup(SEL_2, GPIO.OUT)
 SEL_3 = 23
-GPIO.setup(SEL_3, GPIO.OUT)
 MULTI_INPUT = 26
-GPIO.setup(MULTI_INPUT, GPIO.IN)
 
 # End GPIO pin mappings
 
+# The RPi.GPIO module, set up by setup_gpio. Nothing touches the hardware until then
+GPIO = None
+
+SCAN_TIME = metrics.histogram("scan_inputs")
+WRITE_FRAME_TIME = metrics.histogram("write_frame")
+
+# Imports RPi.GPIO, the pins themselves get set up by Board.setup_pins
+def setup_gpio():
+    global GPIO
+    if(GPIO != None):
+        return
+    import RPi.GPIO as gpio
+    gpio.setmode(gpio.BCM)
+    GPIO = gpio
+
 # Number of multi plexed output bits via using multiple serial to parallel chips daisy chained
 NUM_BITS =40
 
@@ -43,84 +54,333 @@ NUM_VIRTUAL_SOUND_CHANNELS = 8
 # The starting index of output pins that defines where the virtual sound channels start from
 VIRTUAL_SOUND_CHANNEL_OFFSET = 32
 
-# Assumes that the SEL0-4 pins are used to control a parallel multiplexer board that selects from 16 different possible inputs
-def writeInputSelect(val):
-    assert val >= 0 and val < NUM_MULTI_INPUT_PINS
-    #print("Write binary select " + str(bin(val & 0b1111)))
-    writeInputSelectBit(SEL_0, val, 0)
-    writeInputSelectBit(SEL_1, val, 1)
-    writeInputSelectBit(SEL_2, val, 2)
-    writeInputSelectBit(SEL_3, val, 3)
-
-def writeInputSelectBit(pin, val, pos):
-    bit = (val >> pos) & 1
-    GPIO.output(pin, bit)
-
-def readInputBit(pin_num):
-    writeInputSelect(pin_num)
-    time.sleep(CLOCK) # Might not be necessary
-    val = GPIO.input(MULTI_INPUT)
-    return val
-
-# Writes serial data of length NUM_BITS to the SER pin
-def writeSerialData(val):
-    # I accidentally bought all LOW_TRIGGER relays, so invert everything and keep the logic the same
-    val = ~val
-    GPIO.output(RCLK, GPIO.LOW)
-    for i in range(0, NUM_BITS):
-        bit = (val >> (NUM_BITS - 1 - i)) & 1
-        writeSerBit(int(bit))
-    time.sleep(CLOCK)
-    GPIO.output(RCLK, GPIO.HIGH)
-
-# Writes a single serial bit to the SER pin
-def writeSerBit(bit):
-    logging.debug("Writing serial output data: " + str(bin(bit)))
-    GPIO.output(SRCLK, GPIO.LOW)
-    time.sleep(CLOCK)
-    GPIO.output(SER, bit)
-    time.sleep(CLOCK)
-    GPIO.output(SRCLK, GPIO.HIGH)
-    time.sleep(CLOCK)
+# bitmask of the output pins used for the virtual sound channels
+SOUND_CHANNEL_PINS = ((1 << NUM_VIRTUAL_SOUND_CHANNELS) - 1) << VIRTUAL_SOUND_CHANNEL_OFFSET
+
+# Number of consecutive matching samples needed before an input pin is considered to have changed
+INPUT_DEBOUNCE_SAMPLES = 2
+
+# Time to wait after changing the mux select lines before reading. The mux itself settles in nanoseconds which is far
+# less than the time a GPIO call takes, so this is normally left at 0
+INPUT_SETTLE_TIME = 0
+
+# Which output driver is used to write to the shift registers by default (see make_output_driver)
+OUTPUT_DRIVER = "bitbang"
+
+# A chain of daisy chained serial to parallel shift registers. Every chain has its own latch (rclk) and either its own
+# ser/srclk pins (bitbang driver) or its own spi bus/device (spi driver), so separate chains can be written at the same time
+class OutputChain():
+    def __init__(self, num_bits, rclk, ser=None, srclk=None, spi_bus=0, spi_device=0, driver=OUTPUT_DRIVER):
+        self.num_bits = num_bits
+        self.num_bytes = frame_bytes(num_bits)
+        self.rclk = rclk
+        self.ser = ser
+        self.srclk = srclk
+        self.spi_bus = spi_bus
+        self.spi_device = spi_device
+        self.driver = driver
+        # index of the chain's bit 0 in the virtual output pins, set by Board
+        self.first_pin = 0
+
+    def gpio_pins(self):
+        return [pin for pin in [self.ser, self.srclk, self.rclk] if pin != None]
+
+# A 16 channel parallel multiplexer with its own select and data lines
+class MuxBank():
+    def __init__(self, select_pins, data_pin, num_inputs):
+        self.select_pins = select_pins
+        self.data_pin = data_pin
+        self.num_inputs = num_inputs
+        # index of the bank's input 0 in the input pins, set by Board
+        self.first_pin = 0
+
+# How the layout's hardware is wired up. Output chains and mux banks are numbered in order, so the first chain has the
+# virtual output pins 0 to num_bits - 1, the second chain carries on from there and so on (the same goes for inputs)
+class Board():
+    def __init__(self, chains, mux_banks):
+        self.chains = chains
+        self.mux_banks = mux_banks
+        self.num_output_pins = 0
+        for chain in chains:
+            chain.first_pin = self.num_output_pins
+            self.num_output_pins += chain.num_bits
+        self.num_input_pins = 0
+        for bank in mux_banks:
+            bank.first_pin = self.num_input_pins
+            self.num_input_pins += bank.num_inputs
+        # virtual output pin -> (chain index, byte index in the chain's frame, bit mask)
+        self.pin_locations = []
+        for (index, chain) in enumerate(chains):
+            for bit in range(chain.num_bits):
+                self.pin_locations.append((index, chain.num_bytes - 1 - bit // 8, 1 << (bit % 8)))
+
+    def setup_pins(self, gpio):
+        for chain in self.chains:
+            for pin in chain.gpio_pins():
+                gpio.setup(pin, gpio.OUT)
+        for bank in self.mux_banks:
+            for pin in bank.select_pins:
+                gpio.setup(pin, gpio.OUT)
+            gpio.setup(bank.data_pin, gpio.IN)
+
+# The layout as it is wired today: one 40 bit chain and one mux with 3 inputs in use
+BOARD = Board([OutputChain(NUM_BITS, RCLK, ser=SER, srclk=SRCLK)],
+        [MuxBank([SEL_0, SEL_1, SEL_2, SEL_3], MULTI_INPUT, NUM_MULTI_INPUT_PINS)])
+
+# Creates the driver used to write the chain's output pin image to its shift registers, depending on chain.driver
+#   bitbang : clocks each bit out with GPIO writes, sleeping CLOCK between edges (SER, SRCLK, RCLK)
+#   spi     : one bulk transfer over the SPI peripheral (SER on MOSI, SRCLK on SCLK, RCLK as wired above)
+#   fake    : records frames without touching any hardware
+def make_output_driver(chain):
+    name = chain.driver
+    if(name != "fake"):
+        setup_gpio()
+    if(name == "bitbang"):
+        return BitBangDriver(GPIO, chain.ser, chain.srclk, chain.rclk, chain.num_bits, CLOCK)
+    elif(name == "spi"):
+        return SpiDriver(GPIO, chain.rclk, chain.num_bits, chain.spi_bus, chain.spi_device)
+    elif(name == "fake"):
+        return FakeDriver()
+    raise ValueError("Unknown output driver: " + str(name))
 
 # Main io class. This also implements the train_sound_handler virtual_sound_channel_mgr interface so that it can make
 # callbacks to this to enable and disable virtual sound channels
+# Output pin state is kept per chain as a bytearray in the same layout as the frame the drivers shift out, so writing a
+# frame is just a copy of the chain's bytes. Only chains whose bytes changed get written, and if more than one chain
+# changed they are written at the same time on separate threads (the drivers spend most of their time sleeping
+# between clock edges or waiting on the spi transfer).
 class TrainIo():
-    def __init__(self):
-        self.virtual_output_pin_state = 0b00000000
+    # output_drivers is a list with a driver for every chain on the board (a single driver is fine for a one chain board)
+    # initial_output_state is the first frame written (bit n = virtual output pin n), i.e. so that a restarted process
+    # carries on with the relays as they were instead of turning them all off
+    def __init__(self, output_drivers=None, board=None, sound_handler=True, initial_output_state=0):
+        setup_gpio()
+        if(board == None):
+            board = BOARD
+        self.board = board
+        board.setup_pins(GPIO)
+        if(output_drivers == None):
+            output_drivers = [make_output_driver(chain) for chain in board.chains]
+        elif(not isinstance(output_drivers, list)):
+            output_drivers = [output_drivers]
+        assert len(output_drivers) == len(board.chains)
+        self.output_drivers = output_drivers
+        self.chain_executor = None
+        if(len(board.chains) > 1):
+            self.chain_executor = ThreadPoolExecutor(max_workers=len(board.chains), thread_name_prefix="output-chain")
+        self.input_samplers = [InputSampler(GpioMux(GPIO, bank.select_pins, bank.data_pin), bank.num_inputs,
+                INPUT_DEBOUNCE_SAMPLES, INPUT_SETTLE_TIME) for bank in board.mux_banks]
+        self.chain_states = [bytearray(chain.num_bytes) for chain in board.chains]
         self.virtual_sound_channel_state = 0b00000000
-        self.sound_handler = SoundHandler(self)
-        # Turn all output bits off
-        for i in range(NUM_BITS):
-            self.__setup_output_pin_state(i, PIN_OFF)
-        writeSerialData(self.virtual_output_pin_state)
+        # the bytes of every chain that were last actually written to the shift registers
+        self.written_chain_states = [bytes(chain.num_bytes) for chain in board.chains]
+        # per chain, virtual pin -> (byte, mask, pwm level) for the pins that are being dimmed
+        self.pwm_levels = [{} for chain in board.chains]
+        # per chain, the thread refreshing its pwm bit planes while it has any dimmed pins
+        self.refreshers = [None for chain in board.chains]
+        # chains whose pwm levels changed since the last flush
+        self.pwm_changed = set()
+        # while true dimmed pins aren't refreshed, they're written as plain on or off (see suspend_refresh)
+        self.refresh_suspended = False
+        # see recorder.attach
+        self.recorder = None
+        # while > 0, output pin changes are only staged and get written once the outermost batch ends
+        self.batch_depth = 0
+        # true if output pins have been written since the last flush
+        self.output_dirty = False
+        # frames actually sent to the shift registers, and flushes skipped because the pins already had those values
+        self.frames_written = 0
+        self.frames_saved = 0
+        self.sound_handler = None
+        if(sound_handler):
+            self.sound_handler = SoundHandler(self)
+        self.__set_chain_states(initial_output_state)
+        self.__write_frame(range(len(board.chains)))
+
+    # The output pin state of every chain as a single int (bit n = virtual output pin n)
+    @property
+    def virtual_output_pin_state(self):
+        val = 0
+        for (chain, state) in zip(self.board.chains, self.chain_states):
+            val |= int.from_bytes(state, "big") << chain.first_pin
+        return val
 
     def read_input_pin_state(self, pin):
-        return readInputBit(pin)
+        for (bank, sampler) in zip(self.board.mux_banks, self.input_samplers):
+            if(pin < bank.first_pin + bank.num_inputs):
+                return sampler.read_pin(pin - bank.first_pin)
+        raise IndexError("No input pin " + str(pin))
+
+    # Samples every input pin in one pass
+    # returns a tuple of (debounced input pin state, bitmask of the pins that changed)
+    def scan_input_pins(self):
+        state = 0
+        changed = 0
+        with metrics.timer(SCAN_TIME):
+            for (bank, sampler) in zip(self.board.mux_banks, self.input_samplers):
+                changed |= sampler.sample() << bank.first_pin
+                state |= sampler.state << bank.first_pin
+        return (state, changed)
+
+    def get_output_pin_state(self, virtual_pin_index):
+        (chain, byte, mask) = self.board.pin_locations[virtual_pin_index]
+        return 1 if self.chain_states[chain][byte] & mask else 0
     
     # sets output pin state without actually writing the data
     def __setup_output_pin_state(self, virtual_pin_index, state):
-        logging.debug("setting output pin state for index:" + str(virtual_pin_index) + " to state " + str(state))
-        assert virtual_pin_index >= 0 and virtual_pin_index <= NUM_BITS
+        log.debug("setting output pin state for index:%d to state %d", virtual_pin_index, state)
+        assert virtual_pin_index >= 0 and virtual_pin_index < self.board.num_output_pins
         assert state >= PIN_OFF and state <= PIN_ON
 
-        res = self.virtual_output_pin_state
+        (chain, byte, mask) = self.board.pin_locations[virtual_pin_index]
         if(state == 1):
-            res = res | (1 << virtual_pin_index)
+            self.chain_states[chain][byte] |= mask
         else:
-            res = res & ~(1 << virtual_pin_index)
-        self.virtual_output_pin_state = res
-        logging.debug("updated virtual output pins:" + bin(self.virtual_output_pin_state))
+            self.chain_states[chain][byte] &= ~mask
+
+    def __set_chain_states(self, state):
+        for (chain, chain_state) in zip(self.board.chains, self.chain_states):
+            chain_state[:] = ((state >> chain.first_pin) & ((1 << chain.num_bits) - 1)).to_bytes(chain.num_bytes, "big")
 
+    # Sets every output pin at once (bit n = virtual output pin n), written as a single frame. Dimmed pins stay dimmed
+    def write_output_pin_states(self, state):
+        self.__set_chain_states(state)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    # Only writes a frame if the pin actually changes, writing a pin with the value it already has is a no-op
     def write_output_pin_state(self, virtual_pin_index, state):
         self.__setup_output_pin_state(virtual_pin_index, state)
-        writeSerialData(self.virtual_output_pin_state)
+        (chain, byte, mask) = self.board.pin_locations[virtual_pin_index]
+        if(virtual_pin_index in self.pwm_levels[chain]):
+            # writing a dimmed pin turns the dimming off
+            del self.pwm_levels[chain][virtual_pin_index]
+            self.pwm_changed.add(chain)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    # Starts a batch of output pin changes. Changes made with write_output_pin_state are only staged until
+    # the matching end_batch, which writes a single frame containing all of them. Batches can be nested.
+    def begin_batch(self):
+        self.batch_depth += 1
+
+    def end_batch(self):
+        assert self.batch_depth > 0
+        self.batch_depth -= 1
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    # Dims the pin to duty (0 to 1) with software pwm, duty 0 and 1 are just off and on.
+    # While any pin on a chain is dimmed, a refresher thread keeps shifting that chain's bit planes out
+    # (see pwm.py), otherwise frames are only written when something changes
+    def set_output_duty(self, virtual_pin_index, duty):
+        level = pwm.duty_level(duty)
+        (chain, byte, mask) = self.board.pin_locations[virtual_pin_index]
+        levels = self.pwm_levels[chain]
+        if(level == 0 or level == (1 << pwm.PWM_BITS) - 1):
+            self.write_output_pin_state(virtual_pin_index, PIN_ON if level > 0 else PIN_OFF)
+            return
+        levels[virtual_pin_index] = (byte, mask, level)
+        self.pwm_changed.add(chain)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    # Stops the pwm refreshers (i.e. while the layout is idle), dimmed pins are left as they were last written with
+    # write_output_pin_state until resume_refresh
+    def suspend_refresh(self):
+        self.__set_refresh_suspended(True)
+
+    def resume_refresh(self):
+        self.__set_refresh_suspended(False)
+
+    def __set_refresh_suspended(self, suspended):
+        self.refresh_suspended = suspended
+        for chain in range(len(self.pwm_levels)):
+            if(len(self.pwm_levels[chain]) > 0):
+                self.pwm_changed.add(chain)
+        self.output_dirty = True
+        if(self.batch_depth == 0):
+            self.flush_output()
+
+    def get_output_duty(self, virtual_pin_index):
+        (chain, byte, mask) = self.board.pin_locations[virtual_pin_index]
+        if(virtual_pin_index in self.pwm_levels[chain]):
+            return self.pwm_levels[chain][virtual_pin_index][2] / ((1 << pwm.PWM_BITS) - 1)
+        return float(self.get_output_pin_state(virtual_pin_index))
+
+    # Writes the staged output pin state of every chain that differs from what was last written
+    def flush_output(self):
+        changed = [i for i in range(len(self.chain_states))
+                if self.chain_states[i] != self.written_chain_states[i] or i in self.pwm_changed]
+        if(len(changed) > 0):
+            self.__write_frame(changed)
+        elif(self.output_dirty):
+            self.frames_saved += 1
+        self.output_dirty = False
+
+    # Writes the current state of the given chains, or hands it to their pwm refresher
+    def __write_frame(self, chains):
+        # take a copy first, the state can be changed by another thread while the frame is being written
+        frames = []
+        for i in chains:
+            data = bytes(self.chain_states[i])
+            self.pwm_changed.discard(i)
+            if(self.__update_refresher(i, data)):
+                self.written_chain_states[i] = data
+            else:
+                frames.append((i, data))
+        with metrics.timer(WRITE_FRAME_TIME):
+            if(len(frames) == 1 or self.chain_executor == None):
+                for (i, data) in frames:
+                    self.output_drivers[i].write_frame(data)
+            else:
+                writes = [self.chain_executor.submit(self.output_drivers[i].write_frame, data) for (i, data) in frames]
+                for write in writes:
+                    write.result()
+        for (i, data) in frames:
+            self.written_chain_states[i] = data
+        if(len(frames) > 0):
+            self.frames_written += 1
+        if(self.recorder != None):
+            self.recorder.record_frame(self.virtual_output_pin_state)
+
+    # Starts, updates or stops the chain's pwm refresher. Returns True if the refresher is taking care of the chain
+    def __update_refresher(self, chain, data):
+        levels = self.pwm_levels[chain]
+        refresher = self.refreshers[chain]
+        if(len(levels) == 0 or self.refresh_suspended):
+            if(refresher != None):
+                refresher.stop()
+                self.refreshers[chain] = None
+            return False
+        planes = pwm.make_planes(data, levels.values())
+        if(refresher == None):
+            refresher = pwm.BcmRefresher(self.output_drivers[chain], planes, name="PWM_chain" + str(chain))
+            self.refreshers[chain] = refresher
+            refresher.start()
+        else:
+            refresher.set_planes(planes)
+        return True
     
     def get_all_input_pins(self):
-        return range(0, NUM_MULTI_INPUT_PINS)
+        return range(0, self.board.num_input_pins)
+
+    def get_all_output_pins(self):
+        return range(0, self.board.num_output_pins)
+
+    def play_sound(self, name, virtual_channel, priority=0):
+        if(self.recorder != None):
+            self.recorder.record_sound(name, virtual_channel, priority)
+        if(self.sound_handler != None):
+            self.sound_handler.play_sound(name, virtual_channel, priority)
 
-    def play_sound(self, name, virtual_channel):
-        self.sound_handler.play_sound(name, virtual_channel)
+    # dispatcher(action) is used to run sound completion handling on the main loop's thread
+    def set_sound_dispatcher(self, dispatcher):
+        if(self.sound_handler != None):
+            self.sound_handler.set_dispatcher(dispatcher)
 
     def print_state(self):
         print("virtualPins:" + bin(self.virtual_output_pin_state))
@@ -141,7 +401,7 @@ class TrainIo():
     # end implement interface
 
     def performTest(self):
-        for i in range(NUM_BITS):
+        for i in range(self.board.num_output_pins):
             self.write_output_pin_state(i, PIN_OFF)
         time.sleep(1)
         # Go through the lower 8 pins and turn them on
@@ -170,7 +430,7 @@ class TrainIo():
         time.sleep(2)
         # Read the first 8 inputs and pipe the result into the output pins
         print("Loop through inputs 0 through 8 and pipe result into output pins 0 through 8")
-        for i in range(NUM_MULTI_INPUT_PINS):
+        for i in range(self.board.num_input_pins):
             val = self.read_input_pin_state(i)
             self.write_output_pin_state(i, val)
             time.sleep(1)
@@ -196,7 +456,7 @@ def main():
         print("Testing complete")
     elif(func_type == "output_test"):
         output_pin_index = int(sys.argv[1])
-        assert output_pin_index >= 0 and output_pin_index <= NUM_BITS
+        assert output_pin_index >= 0 and output_pin_index < BOARD.num_output_pins
         v = TrainIo()
         v.write_output_pin_state(output_pin_index, PIN_OFF)
         time.sleep(.5)
@@ -205,7 +465,7 @@ def main():
         v.write_output_pin_state(output_pin_index, PIN_OFF)
     elif(func_type == "input_test"):
         input_pin_index = int(sys.argv[2])
-        assert input_pin_index >= 0 and input_pin_index <= NUM_MULTI_INPUT_PINS
+        assert input_pin_index >= 0 and input_pin_index < BOARD.num_input_pins
         v = TrainIo()
         val = v.read_input_pin_state(input_pin_index)
         print("read value: " + str(val) + " from input pin " + str(input_pin_index))
@@ -0,0 +1,95 @@
+# Logging setup for the layout.
+# Modules log through their own logging.getLogger(__name__) with %-style arguments, i.e.
+#   log.debug("Found changed state for pin %d", pin)
+# so a message below its module's level is dropped before anything gets formatted. Records that make it through are
+# put on a queue as they are, and get formatted and written to the log file by a listener thread, so the main loop
+# never waits on formatting or disk I/O. Because formatting happens later on another thread, only pass values that
+# won't change afterwards (numbers, strings) as arguments.
+#
+# Structured fields can be attached to any record and end up as key=value pairs at the end of the line
+#   log.info("Trigger running", extra=trainlog.fields(trigger=self.name, pin=self.trigger_pin))
+#
+# The log file is rotated by size, which replaces rotating it by hand every time the layout starts.
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FILE = "logs/app.log"
+MAX_LOG_BYTES = 5 * 1024 * 1024
+# how many rotated log files to keep around (app.log.1 ... app.log.5)
+LOG_BACKUP_COUNT = 5
+
+DEFAULT_LEVEL = logging.INFO
+
+# module name -> level, for modules that should log at something other than DEFAULT_LEVEL
+# setting output_drivers to DEBUG traces every bit that gets shifted out, which slows the frames down a lot
+MODULE_LEVELS = {
+    "output_drivers": logging.INFO,
+    "trainio": logging.INFO,
+    "triggers": logging.INFO,
+}
+
+# Extra levels can be given without editing this file, i.e. TRAIN_LOG_LEVELS=triggers=DEBUG,output_drivers=DEBUG
+LEVELS_ENV_VAR = "TRAIN_LOG_LEVELS"
+
+FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"
+
+def fields(**kwargs):
+    return {"fields": kwargs}
+
+class FieldsFormatter(logging.Formatter):
+    def format(self, record):
+        line = super(FieldsFormatter, self).format(record)
+        record_fields = getattr(record, "fields", None)
+        if(record_fields):
+            line += " " + " ".join(key + "=" + str(record_fields[key]) for key in record_fields)
+        return line
+
+# The standard QueueHandler formats the message on the logging thread before queueing it, this leaves it to the listener
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Parses "name=LEVEL,name=LEVEL" into a dict of module name -> level
+def parse_levels(text):
+    levels = {}
+    for item in text.split(","):
+        if(item.strip() == ""):
+            continue
+        (name, sep, level) = item.partition("=")
+        # getLevelName maps known level names to their number
+        level = logging.getLevelName(level.strip().upper())
+        if(sep == "" or type(level) != int):
+            raise ValueError("Bad log level setting: " + item)
+        levels[name.strip()] = level
+    return levels
+
+# Sends all logging through the queue to a size rotated log file (and to stderr as well if console is true).
+# Returns the listener, which gets stopped (flushing anything still queued) when the process exits
+def setup(filename=LOG_FILE, levels=None, console=False):
+    if(levels == None):
+        levels = dict(MODULE_LEVELS)
+        levels.update(parse_levels(os.environ.get(LEVELS_ENV_VAR, "")))
+    directory = os.path.dirname(filename)
+    if(directory != ""):
+        os.makedirs(directory, exist_ok=True)
+    formatter = FieldsFormatter(FORMAT)
+    handlers = [logging.handlers.RotatingFileHandler(filename, maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUP_COUNT)]
+    if(console):
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(DEFAULT_LEVEL)
+    for name in levels:
+        logging.getLogger(name).setLevel(levels[name])
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
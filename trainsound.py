@@ -1,28 +1,50 @@
 # Defines a Sound that rotates through multiple files
 # these files are mutually exclusive. If a sound is in progress and play is called again, nothing will happen
-from os import listdir
-from os.path import isfile, join
+# The directory isn't looked at until the sound is first used (see load_files)
+from os.path import join
 import time
 import logging
 import random
+import threading
 import simple_sound_lib
+import sound_cache
+import sound_manifest
+
+log = logging.getLogger(__name__)
 
 class Sound:
-    def __init__(self, dirname):
+    def __init__(self, dirname, cache=None):
         # name of directory that the sounds reside in
         self.dirname = dirname
-        self.update_known_files()
+        # decoded audio cache, defaults to the one shared by all sounds
+        self.cache = cache
+        # None until the directory has been looked at
+        self.files = None
+        self.durations = {}
+        self.load_lock = threading.Lock()
         self.curr_sound_handle = None
 
+    # Looks up the files in the directory (through the sound manifest) the first time it's called
+    def load_files(self):
+        with self.load_lock:
+            if(self.files == None):
+                self.update_known_files()
+
     def update_known_files(self):
-        self.files = [f for f in listdir(self.dirname) if isfile(join(self.dirname, f))]
-        if(len(self.files) < 1):
-            print("sound with dir " + self.dirname + " has no files found in the directory")
+        entries = sound_manifest.get_manifest().files(self.dirname)
+        self.durations = {}
+        for entry in entries:
+            self.durations[entry["name"]] = entry["duration"]
+        if(len(entries) < 1):
+            log.warning("sound with dir %s has no files found in the directory", self.dirname)
+            self.file_index = 0
         else:
-            print("sound with dir " + self.dirname + " found files " + str(self.files))
-        self.file_index = random.randrange(len(self.files))
+            log.debug("sound with dir %s found %d files", self.dirname, len(entries))
+            self.file_index = random.randrange(len(entries))
+        self.files = [entry["name"] for entry in entries]
 
     def num_files(self):
+        self.load_files()
         return len(self.files)
 
     def next_file(self):
@@ -31,22 +53,53 @@ class Sound:
         self.file_index = (self.file_index + 1) % self.num_files()
         return self.files[self.file_index] 
 
+    def get_cache(self):
+        if(self.cache == None):
+            return sound_cache.get_cache()
+        return self.cache
+
+    # Decodes all of this sound's short clips into the cache so they play from memory
+    def preload(self):
+        self.load_files()
+        for f in self.files:
+            self.get_cache().load(join(self.dirname, f))
+
     def is_playing(self):
         if(self.curr_sound_handle == None):
             return False
         return not simple_sound_lib.is_finished(self.curr_sound_handle)
 
+    # Returns the handle of the sound that is playing afterwards (which is the sound that was already playing if there was
+    # one), or None if there is nothing to play
     def play_next_sound(self):
         if(self.is_playing()):
-            print("play_next_sound invoked for sound " + self.dirname + " but sound is already in progress")
+            log.debug("play_next_sound invoked for sound %s but sound is already in progress", self.dirname)
+            return self.curr_sound_handle
+        log.debug("Going to play next sound since none is in progress for sound %s", self.dirname)
+        return self.play_new_sound()
+
+    # Starts the next file even if the sound is already playing. Returns its handle, or None if there is nothing to play
+    def play_new_sound(self):
+        f = self.next_file()
+        if(f == None):
+            return None
+        filename = join(self.dirname, f)
+        pcm = self.get_cache().get(filename)
+        if(pcm != None):
+            self.curr_sound_handle = simple_sound_lib.play_pcm(pcm)
         else:
-            print("Going to play next sound since none is in progress for sound " + self.dirname)
-            f = self.next_file()
-            self.curr_sound_handle = simple_sound_lib.play_sound(join(self.dirname, f))
+            self.curr_sound_handle = simple_sound_lib.play_sound(filename)
+        return self.curr_sound_handle
+
+    # Stops one of this sound's handles. It no longer counts as playing, even while its player is still shutting down
+    def stop_sound(self, handle):
+        if(self.curr_sound_handle is handle):
+            self.curr_sound_handle = None
+        simple_sound_lib.stop_sound(handle)
 
     def stop_current_sound(self):
         if(self.curr_sound_handle != None):
-            simple_sound_lib.stop_sound(self.curr_sound_handle)
+            self.stop_sound(self.curr_sound_handle)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,277 @@
+# The world state (input pins and who is interested in them) and the triggers that react to input changes
+import heapq
+import logging
+from array import array
+import clock
+import trainio
+import animation
+from events import LatenessStats
+from input_sampler import iter_bits, SamplerThread
+import trainlog
+
+log = logging.getLogger(__name__)
+
+# Input change subscribers are kept in a flat table: subscribers[i] is the i-th subscriber and
+# pin_subscriber_masks[pin] has bit i set if subscriber i cares about that pin. A scan result gets dispatched by
+# XORing the old and new input words, masking with the pins anybody watches and looking up the subscribers of each
+# changed pin, so pins nobody cares about cost nothing. Triggers don't subscribe, they're kept in a TriggerTable that
+# gets checked the same way.
+class WorldState:
+    def __init__(self, event_queue, io):
+        self.event_queue = event_queue
+        # bit packed state of all input pins (bit n = input pin n)
+        self.input_pin_states = 0
+        self.io = io
+        # how long it takes from the sampler thread seeing an input change until subscribers get called
+        self.input_latency = LatenessStats("Input")
+        self.sampler_thread = None
+        self.num_input_pins = len(io.get_all_input_pins())
+        self.num_output_pins = len(io.get_all_output_pins())
+        self.subscribers = []
+        self.pin_subscriber_masks = [0] * self.num_input_pins
+        # bitmask of the input pins that have at least one subscriber
+        self.watched_pins = 0
+        self.trigger_table = TriggerTable(self.num_input_pins)
+        self.animator = animation.Animator(self)
+        # see recorder.attach
+        self.recorder = None
+        # see power.PowerScheduler
+        self.power = None
+        # see control.serve
+        self.control = None
+
+    def get_current_pin_state(self, pin):
+        return (self.input_pin_states >> pin) & 1
+
+    def write_pin_state(self, pin, state):
+        self.io.write_output_pin_state(pin, state)
+
+    def scan_inputs(self):
+        log.debug("World state scanning all inputs")
+        (state, changed) = self.io.scan_input_pins()
+        self.apply_input_change(state, changed)
+
+    # How often to sample the inputs, which is less often while the layout is idle (see power.py)
+    def sample_interval(self, interval):
+        if(self.power == None):
+            return interval
+        return self.power.sample_interval(interval)
+
+    # Starts sampling the inputs on a background thread. Changes get posted to the event queue so that
+    # subscribers are still only ever called from the main loop
+    def start_sampler_thread(self, interval):
+        def on_change(state, changed):
+            detected_at = clock.now()
+            self.event_queue.post_threadsafe(lambda: self.apply_input_change(state, changed, detected_at))
+        self.sampler_thread = SamplerThread(self.io.scan_input_pins, interval, on_change, self.sample_interval)
+        self.sampler_thread.start()
+
+    def apply_input_change(self, state, changed, detected_at=None):
+        if(detected_at != None):
+            self.input_latency.record(detected_at, clock.now())
+        if(self.recorder != None and changed):
+            self.recorder.record_input(clock.now() if detected_at == None else detected_at, state, changed)
+        self.input_pin_states = state
+        if(self.power != None and changed):
+            self.power.input_changed(clock.now() if detected_at == None else detected_at)
+        for trigger in self.trigger_table.ready(state, changed, clock.now()):
+            trigger.fire()
+        for pin in iter_bits(changed & self.watched_pins):
+            log.debug("Found changed state for pin %d", pin)
+            for index in iter_bits(self.pin_subscriber_masks[pin]):
+                log.debug("calling subscriber for pin %d", pin)
+                self.subscribers[index]()
+
+    # Returns a subscription id that can be passed to unsubscribe
+    def subscribe_to_state_change(self, pin_index, subscriber):
+        assert pin_index >= 0 and pin_index < self.num_input_pins
+        index = len(self.subscribers)
+        self.subscribers.append(subscriber)
+        self.pin_subscriber_masks[pin_index] |= 1 << index
+        self.watched_pins |= 1 << pin_index
+        return index
+
+    def unsubscribe(self, index):
+        self.subscribers[index] = None
+        for pin in range(self.num_input_pins):
+            self.pin_subscriber_masks[pin] &= ~(1 << index)
+            if(self.pin_subscriber_masks[pin] == 0):
+                self.watched_pins &= ~(1 << pin)
+        # once everybody is gone (i.e. a layout reload) start numbering from scratch again
+        while(len(self.subscribers) > 0 and self.subscribers[-1] == None):
+            self.subscribers.pop()
+
+# The state every trigger's fire check needs, kept as a struct of arrays so that a scan result gets checked against all
+# of the triggers on the changed pins in one go instead of calling each of them.
+# Trigger i watches pins[i] and is cooling down until cooloffs[i], bit i of on_mask is set while it's on, and
+# pin_masks[pin] has bit i set for every trigger on that pin (like WorldState.pin_subscriber_masks). Slots of removed
+# triggers get reused, lowest first, so the masks stay as short as the layout
+class TriggerTable():
+    def __init__(self, num_input_pins):
+        self.triggers = []
+        self.pins = array("H")
+        self.cooloffs = array("d")
+        self.on_mask = 0
+        self.pin_masks = [0] * num_input_pins
+        # bitmask of the input pins that have at least one trigger
+        self.watched_pins = 0
+        # heap of free slots
+        self.free = []
+
+    def __len__(self):
+        return len(self.triggers) - len(self.free)
+
+    # Returns the trigger's slot
+    def add(self, trigger, pin):
+        assert pin >= 0 and pin < len(self.pin_masks)
+        if(len(self.free) > 0):
+            slot = heapq.heappop(self.free)
+            self.triggers[slot] = trigger
+            self.pins[slot] = pin
+            self.cooloffs[slot] = clock.now()
+        else:
+            slot = len(self.triggers)
+            self.triggers.append(trigger)
+            self.pins.append(pin)
+            self.cooloffs.append(clock.now())
+        self.pin_masks[pin] |= 1 << slot
+        self.watched_pins |= 1 << pin
+        return slot
+
+    def remove(self, slot):
+        pin = self.pins[slot]
+        self.triggers[slot] = None
+        self.on_mask &= ~(1 << slot)
+        self.pin_masks[pin] &= ~(1 << slot)
+        if(self.pin_masks[pin] == 0):
+            self.watched_pins &= ~(1 << pin)
+        heapq.heappush(self.free, slot)
+
+    def is_on(self, slot):
+        return (self.on_mask >> slot) & 1 == 1
+
+    def set_on(self, slot, on):
+        if(on):
+            self.on_mask |= 1 << slot
+        else:
+            self.on_mask &= ~(1 << slot)
+
+    # Returns the triggers that should fire now that the pins in changed have changed to state: the ones on a pin that
+    # just turned on, which aren't on already and aren't cooling down. In slot order
+    def ready(self, state, changed, now):
+        candidates = 0
+        for pin in iter_bits(changed & state & self.watched_pins):
+            candidates |= self.pin_masks[pin]
+        candidates &= ~self.on_mask
+        cooloffs = self.cooloffs
+        triggers = self.triggers
+        return [triggers[slot] for slot in iter_bits(candidates) if cooloffs[slot] <= now]
+
+# Triggers (and Events) are slotted, so a big layout doesn't cost a dict per trigger. Subclasses have to declare
+# __slots__ as well or they get a dict back
+class Trigger:
+    __slots__ = ("worldstate", "name", "cooldown_duration", "trigger_pin", "sound_name", "sound_channel", "sound_priority",
+            "slot")
+
+    def __init__(self, name, worldstate, cooldown_duration, trigger_pin, sound_name, sound_channel):
+        self.worldstate = worldstate
+        self.name = name
+        self.cooldown_duration = cooldown_duration
+        self.trigger_pin = trigger_pin
+        self.sound_name = sound_name
+        self.sound_channel = sound_channel
+        # sounds with a higher priority preempt ones with a lower priority (see SoundHandler)
+        self.sound_priority = 0
+        self.slot = worldstate.trigger_table.add(self, trigger_pin)
+
+    # on and cooloff live in the world state's trigger table (a removed trigger is never on)
+    @property
+    def on(self):
+        return self.slot != None and self.worldstate.trigger_table.is_on(self.slot)
+
+    @on.setter
+    def on(self, on):
+        self.worldstate.trigger_table.set_on(self.slot, on)
+
+    @property
+    def cooloff(self):
+        return self.worldstate.trigger_table.cooloffs[self.slot]
+
+    @cooloff.setter
+    def cooloff(self, cooloff):
+        self.worldstate.trigger_table.cooloffs[self.slot] = cooloff
+
+    # Fires the trigger if its pin is on and it isn't already on or cooling down. Input changes don't go through here,
+    # the world state checks all the triggers on the changed pins at once (see TriggerTable.ready)
+    def fire_trigger(self):
+        log.debug("Trigger invoked for trigger %s", self.name)
+        if(self.worldstate.get_current_pin_state(self.trigger_pin) == trainio.PIN_ON and not self.on and clock.now() >= self.cooloff):
+            self.fire()
+
+    def fire(self):
+        log.info("Trigger running", extra=trainlog.fields(trigger=self.name, pin=self.trigger_pin))
+        self.trigger_impl()
+        self.cooloff = clock.now() + self.cooldown_duration
+        if(self.sound_name != None):
+            log.debug("Trigger playing sound for trigger %s", self.name)
+            self.worldstate.io.play_sound(self.sound_name, self.sound_channel, self.sound_priority)
+    
+    def trigger_impl(self):
+        pass
+
+    def end_impl(self):
+        pass
+
+    # Ends the trigger, withdrawing any of its events that haven't fired yet
+    def end(self):
+        self.worldstate.event_queue.cancel_owner(self)
+        self.on = False
+        self.end_impl()
+
+    # Takes the trigger out of the layout for good, turning off anything it has turned on
+    def remove(self):
+        if(self.on):
+            self.end()
+        else:
+            self.worldstate.event_queue.cancel_owner(self)
+        if(self.slot != None):
+            self.worldstate.trigger_table.remove(self.slot)
+            self.slot = None
+
+# Runs a compiled animation timeline (see animation.py) on the output pins every time it fires. The trigger stays on
+# until the timeline runs out (or forever, if it never does)
+class PatternTrigger(Trigger):
+    __slots__ = ("timeline",)
+
+    def __init__(self, name, worldstate, cooldown_duration, trigger_pin, timeline, sound, sound_channel):
+        super(PatternTrigger, self).__init__(name, worldstate, cooldown_duration, trigger_pin, sound, sound_channel)
+        self.timeline = timeline
+
+    def trigger_impl(self):
+        self.on = True
+        self.worldstate.animator.start(self.timeline, self, self.end)
+
+    def end_impl(self):
+        self.worldstate.animator.stop_owner(self)
+
+# Turns drive_pin on for duration
+class TimedRelayTrigger(PatternTrigger):
+    __slots__ = ("duration", "drive_pin")
+
+    def __init__(self, name, worldstate, duration, trigger_pin, drive_pin, cooldown_duration, sound, sound_channel):
+        super(TimedRelayTrigger, self).__init__(name, worldstate, cooldown_duration, trigger_pin,
+                animation.hold(drive_pin, duration), sound, sound_channel)
+        self.duration = duration
+        self.drive_pin = drive_pin
+
+# Pulses drive_pin on for pulse_duration every pulse_interval, for duration
+class WigWagRelayTrigger(PatternTrigger):
+    __slots__ = ("duration", "drive_pin", "pulse_duration", "pulse_interval")
+
+    def __init__(self, name, worldstate, duration, trigger_pin, drive_pin, cooldown_duration, pulse_interval, pulse_duration, sound, sound_channel):
+        super(WigWagRelayTrigger, self).__init__(name, worldstate, cooldown_duration, trigger_pin,
+                animation.wigwag(drive_pin, pulse_interval, pulse_duration, duration), sound, sound_channel)
+        self.duration = duration
+        self.drive_pin = drive_pin
+        self.pulse_duration = pulse_duration
+        self.pulse_interval = pulse_interval